@@ -0,0 +1,273 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import click
+
+# Use the zfinds package of this checkout, whether or not it is installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from zfinds.readahead import READ_AHEAD
+from zfinds.stats import STATS
+from zfinds.utils import SCAN_WINDOW
+from zfinds.zfilewriter import ZFileWriter
+from zfinds.zfinds import Zfinds
+
+from zfsimage import PoolImage
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+RESULTS_FILE = 'benchmark-results.jsonl'
+
+
+def build_image(path, size, files, deleted, modified, txgs, noise,
+                max_file_size, seed):
+    """Generate a pool image with a known history.
+
+    The first txg creates the files. Each older uberblock after it removes
+    and modifies a share of the files, so that the contents removed from
+    the file system are known.
+
+    Args:
+        path: The path of the image to create.
+        size: The size of the image in bytes.
+        files: The number of files to create.
+        deleted: The number of files to remove.
+        modified: The number of files to modify.
+        txgs: The number of txgs to write after the one creating the files.
+        noise: The fraction of unallocated space to fill with random data.
+        max_file_size: The maximum size of a file in bytes.
+        seed: The seed of the random generator.
+
+    Returns:
+        A tuple of (live, removed) dictionaries of the digests of the files
+        of the last txg, and of the contents removed from the file system
+        in earlier txgs, to their names.
+    """
+
+    rng = random.Random(seed)
+    image = PoolImage(path, size, seed, noise)
+
+    try:
+        for ii in xrange(files):
+            image.add_file('file{0:05}'.format(ii),
+                           rng.randrange(1, max_file_size + 1))
+
+        image.commit()
+
+        for ii in xrange(txgs):
+            names = sorted(image.files)
+            remove = deleted * (ii + 1) / txgs - deleted * ii / txgs
+            modify = modified * (ii + 1) / txgs - modified * ii / txgs
+
+            for name in rng.sample(names, min(remove, len(names))):
+                image.remove_file(name)
+
+            names = sorted(image.files)
+
+            for name in rng.sample(names, min(modify, len(names))):
+                image.modify_file(name, rng.randrange(1, max_file_size + 1))
+
+            image.commit()
+    finally:
+        image.close()
+
+    live = image.live()
+    removed = dict((digest, name) for digest, name in image.seen.items()
+                   if digest not in live)
+
+    return live, removed
+
+
+def check_recovery(destination, live, removed):
+    """Compare the recovered files with the history of the image.
+
+    Args:
+        destination: The directory the files were recovered to.
+        live: The digests of the files of the last txg.
+        removed: The digests of the contents removed in earlier txgs.
+
+    Returns:
+        A dictionary of the counts of recovered files by method and kind,
+        and the fraction of the removed contents that were recovered.
+    """
+
+    methods = {}
+    recovered = set()
+
+    for file_name in sorted(os.listdir(destination)):
+        if file_name.startswith('.zfinds-'):
+            continue
+
+        with open(os.path.join(destination, file_name), 'rb') as file_:
+            digest = hashlib.sha256(file_.read()).hexdigest()
+
+        if digest in removed:
+            kind = 'removed'
+            recovered.add(digest)
+        elif digest in live:
+            kind = 'live'
+        else:
+            kind = 'unknown'
+
+        method = file_name.rsplit('-', 1)[-1]
+        counts = methods.setdefault(method, {'removed': 0, 'live': 0,
+                                             'unknown': 0})
+        counts[kind] += 1
+
+    return {
+        'expected': len(removed),
+        'recovered': len(recovered),
+        'recall': float(len(recovered)) / len(removed) if removed else 1.0,
+        'methods': methods,
+        }
+
+
+def _revision():
+    """Retrieve the git revision of the source tree, if there is one."""
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--size', default=67108864, show_default=True,
+              type=click.IntRange(min=8388608), help='image size in bytes')
+@click.option('--files', default=200, show_default=True,
+              type=click.IntRange(min=1), help='number of files to create')
+@click.option('--deleted', default=40, show_default=True,
+              type=click.IntRange(min=0), help='number of files to remove')
+@click.option('--modified', default=20, show_default=True,
+              type=click.IntRange(min=0), help='number of files to modify')
+@click.option('--txgs', default=8, show_default=True,
+              type=click.IntRange(min=1, max=127),
+              help='number of older uberblocks to write changes in')
+@click.option('--noise', default=0.5, show_default=True,
+              type=click.FloatRange(0, 1),
+              help='fraction of unallocated space filled with random data')
+@click.option('--max-file-size', default=262144, show_default=True,
+              type=click.IntRange(min=1), help='maximum file size in bytes')
+@click.option('--seed', default=0, show_default=True, help='random seed')
+@click.option('--method', default='all', show_default=True,
+              type=click.Choice(['all', 'brute', 'uber']),
+              help='recovery method to benchmark')
+@click.option('-j', '--jobs', default=1, show_default=True,
+              type=click.IntRange(min=1), help='recovery processes')
+@click.option('--hash-jobs', default=1, show_default=True,
+              type=click.IntRange(min=1), help='hashing threads')
+@click.option('--write-jobs', default=1, show_default=True,
+              type=click.IntRange(min=1), help='writing threads')
+@click.option('-w', '--window-size', default=SCAN_WINDOW, show_default=True,
+              type=click.IntRange(min=512), help='brute scan window size')
+@click.option('--read-ahead', default=READ_AHEAD, show_default=True,
+              type=click.IntRange(min=0), help='blocks and windows read ahead')
+@click.option('--exclude-by', default='identity', show_default=True,
+              type=click.Choice(['identity', 'content']),
+              help='how existing files are kept out of the results')
+@click.option('--space-maps/--no-space-maps', default=False,
+              show_default=True,
+              help='If True, scans the free space of the space maps')
+@click.option('--work-dir', default=None,
+              help='directory to create the image and output in, removed '
+              'afterwards unless --keep is given')
+@click.option('--keep/--no-keep', default=False, show_default=True,
+              help='If True, keeps the image and recovered files')
+@click.option('--results', default=RESULTS_FILE, show_default=True,
+              help='file to append the results of the run to')
+def bench(size, files, deleted, modified, txgs, noise, max_file_size, seed,
+          method, jobs, hash_jobs, write_jobs, window_size, read_ahead,
+          exclude_by, space_maps, work_dir, keep, results):
+    """
+    Benchmark ZFindS against a generated pool image.
+
+    A ZFS version 1 pool image is generated with a known history of files,
+    each recovery phase is timed, and the recovered files are checked
+    against the contents removed from the file system. The parameters,
+    timings, counters and recovery results are appended to the results file
+    as a line of JSON so that runs can be compared over time.
+    """
+
+    logging.basicConfig(level='ERROR')
+
+    work_dir = tempfile.mkdtemp(prefix='zfinds-bench-', dir=work_dir)
+    image = os.path.join(work_dir, 'pool.img')
+    destination = os.path.join(work_dir, 'found')
+
+    try:
+        start = time.time()
+        live, removed = build_image(image, size, files, deleted, modified,
+                                    txgs, noise, max_file_size, seed)
+        generate = time.time() - start
+
+        STATS.reset()
+        writer = ZFileWriter(destination, write_jobs, read_ahead)
+        zfinds = Zfinds(image, writer, hash_jobs=hash_jobs,
+                        read_ahead=read_ahead, exclude_by=exclude_by)
+
+        try:
+            with STATS.timer('build_cache'):
+                zfinds.build_cache()
+
+            if method == 'uber' or method == 'all':
+                with STATS.timer('find_uber'):
+                    zfinds.find_uber(jobs)
+                with STATS.timer('write_uber'):
+                    zfinds.write_uber()
+
+            if method == 'brute' or method == 'all':
+                if space_maps:
+                    with STATS.timer('build_free_map'):
+                        zfinds.build_free_map()
+
+                with STATS.timer('find_brute'):
+                    zfinds.find_brute(window_size, jobs=jobs)
+                with STATS.timer('write_brute'):
+                    zfinds.write_brute()
+        finally:
+            zfinds.close()
+
+        result = {
+            'time': time.time(),
+            'revision': _revision(),
+            'params': {
+                'size': size, 'files': files, 'deleted': deleted,
+                'modified': modified, 'txgs': txgs, 'noise': noise,
+                'max_file_size': max_file_size, 'seed': seed,
+                'method': method, 'jobs': jobs, 'hash_jobs': hash_jobs,
+                'write_jobs': write_jobs, 'window_size': window_size,
+                'read_ahead': read_ahead, 'exclude_by': exclude_by,
+                'space_maps': space_maps,
+                },
+            'generate': generate,
+            'stats': STATS.report(),
+            'recovery': check_recovery(destination, live, removed),
+            }
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir)
+
+    with open(results, 'a') as file_:
+        file_.write(json.dumps(result, sort_keys=True) + '\n')
+
+    timers = result['stats']['timers']
+    recovery = result['recovery']
+    click.echo(' '.join('{0}={1:.2f}s'.format(name, timers[name])
+                        for name in sorted(timers)))
+    click.echo('recovered {0}/{1} removed contents ({2:.0%}), {3}'.format(
+        recovery['recovered'], recovery['expected'], recovery['recall'],
+        json.dumps(recovery['methods'], sort_keys=True)))
+
+
+if __name__ == '__main__':
+    bench()
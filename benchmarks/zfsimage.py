@@ -0,0 +1,1093 @@
+import hashlib
+import random
+import struct
+
+SECTOR_SIZE = 512
+LABEL_SIZE = 262144
+DATA_START = 4194304  # Two front labels and the boot block
+VDEV_PHYS_OFFSET = 16384
+VDEV_PHYS_SIZE = 114688
+UBERBLOCK_OFFSET = 131072
+UBERBLOCK_SIZE = 1024
+UBERBLOCK_COUNT = 128
+DNODE_SIZE = 512
+DNODE_BLOCK = 16384
+RECORD_SIZE = 131072
+INDIRECT_SHIFT = 14
+METASLAB_SHIFT = 24
+METASLAB_SPLIT = 8  # Small vdevs are split in 4 to 8 metaslabs
+SPACE_MAP_BLOCK = 4096
+SPACE_MAP_RESERVE = 131072  # Space the MOS of a txg is written in
+SM_RUN_MAX = 1 << 15
+BLKPTR_SIZE = 128
+MZAP_ENT_SIZE = 64
+MZAP_NAME_LEN = 50
+MZAP_MAX_SIZE = 131072
+
+UBERBLOCK_MAGIC = 0x00bab10c
+ZEC_MAGIC = 0x0210da7ab10c7a11
+ZBT_MICRO = (1 << 63) + 3
+SPA_VERSION = 1
+ZPL_VERSION = 1
+
+CHECKSUM_FLETCHER_2 = 6
+CHECKSUM_FLETCHER_4 = 7
+COMPRESS_OFF = 2
+COMPRESS_LZJB = 3
+
+OT_OBJECT_DIRECTORY = 1
+OT_OBJECT_ARRAY = 2
+OT_PACKED_NVLIST = 3
+OT_PACKED_NVLIST_SIZE = 4
+OT_SPACE_MAP_HEADER = 7
+OT_SPACE_MAP = 8
+OT_DNODE = 10
+OT_OBJSET = 11
+OT_DSL_DIR = 12
+OT_DSL_DIR_CHILD_MAP = 13
+OT_DSL_DS_SNAP_MAP = 14
+OT_DSL_PROPS = 15
+OT_DSL_DATASET = 16
+OT_ZNODE = 17
+OT_PLAIN_FILE_CONTENTS = 19
+OT_DIRECTORY_CONTENTS = 20
+OT_MASTER_NODE = 21
+OT_DELETE_QUEUE = 22
+
+OST_META = 1
+OST_ZFS = 2
+
+S_IFDIR = 0o040000
+S_IFREG = 0o100000
+DT_DIR = 4
+DT_REG = 8
+
+NV_ENCODE_XDR = 1
+NV_UNIQUE_NAME = 1
+DATA_TYPE_UINT64 = 8
+DATA_TYPE_STRING = 9
+DATA_TYPE_NVLIST = 19
+
+EMPTY_BLKPTR = b'\0' * BLKPTR_SIZE
+
+# Object ids of the objects in the MOS and the ZPL object set. File objects
+# are numbered from ZPL_FIRST_FILE.
+MOS_OBJECT_DIRECTORY = 1
+MOS_DSL_DIR = 2
+MOS_CONFIG = 3
+MOS_DSL_DATASET = 4
+MOS_CHILD_MAP = 5
+MOS_PROPS = 6
+MOS_SNAP_MAP = 7
+MOS_METASLAB_ARRAY = 8
+MOS_FIRST_SPACE_MAP = 9
+ZPL_MASTER_NODE = 1
+ZPL_DELETE_QUEUE = 2
+ZPL_ROOT = 3
+ZPL_FIRST_FILE = 4
+
+BASE_TIME = 1262304000  # Creation time of generated pools
+
+
+def fletcher2(data):
+    """Generate the fletcher2 checksum of a block.
+
+    Args:
+        data: The data of the block, a multiple of 16 bytes long.
+
+    Returns:
+        A tuple of the four checksum words.
+    """
+
+    a0 = a1 = b0 = b1 = 0
+    mask = (1 << 64) - 1
+    words = struct.unpack('<{0}Q'.format(len(data) / 8), data)
+
+    for ii in xrange(0, len(words), 2):
+        a0 = (a0 + words[ii]) & mask
+        a1 = (a1 + words[ii + 1]) & mask
+        b0 = (b0 + a0) & mask
+        b1 = (b1 + a1) & mask
+
+    return a0, a1, b0, b1
+
+
+def fletcher4(data):
+    """Generate the fletcher4 checksum of a block.
+
+    Args:
+        data: The data of the block, a multiple of 4 bytes long.
+
+    Returns:
+        A tuple of the four checksum words.
+    """
+
+    a = b = c = d = 0
+    mask = (1 << 64) - 1
+
+    for word in struct.unpack('<{0}I'.format(len(data) / 4), data):
+        a = (a + word) & mask
+        b = (b + a) & mask
+        c = (c + b) & mask
+        d = (d + c) & mask
+
+    return a, b, c, d
+
+
+def lzjb_compress(data):
+    """Compress data with LZJB.
+
+    Args:
+        data: The data to compress.
+
+    Returns:
+        The compressed data, or None if it would not be smaller than the
+        data given.
+    """
+
+    src = bytearray(data)
+    length = len(src)
+    dst = bytearray()
+    lempel = [0] * 1024
+    copymask = 1 << 7
+    copymap = 0
+    pos = 0
+
+    while pos < length:
+        copymask <<= 1
+
+        if copymask == 1 << 8:
+            if len(dst) >= length - 1 - 2 * 8:
+                return None
+
+            copymask = 1
+            copymap = len(dst)
+            dst.append(0)
+
+        if pos > length - 66:
+            dst.append(src[pos])
+            pos += 1
+            continue
+
+        hsh = (src[pos] << 16) + (src[pos + 1] << 8) + src[pos + 2]
+        hsh += hsh >> 9
+        hsh += hsh >> 5
+        hsh &= 1023
+        offset = (pos - lempel[hsh]) & 1023
+        lempel[hsh] = pos & 0xffff
+        cpy = pos - offset
+
+        if (cpy >= 0 and cpy != pos and
+                src[pos:pos + 3] == src[cpy:cpy + 3]):
+            dst[copymap] |= copymask
+            mlen = 3
+
+            while mlen < 66 and src[pos + mlen] == src[cpy + mlen]:
+                mlen += 1
+
+            dst.append(((mlen - 3) << 2) | (offset >> 8))
+            dst.append(offset & 0xff)
+            pos += mlen
+        else:
+            dst.append(src[pos])
+            pos += 1
+
+    return bytes(dst)
+
+
+def _roundup(value, size):
+    """Round a value up to a multiple of size."""
+
+    return (value + size - 1) / size * size
+
+
+def _xdr_string(value):
+    """Encode a string with XDR."""
+
+    return struct.pack('>I', len(value)) + value + \
+        b'\0' * (_roundup(len(value), 4) - len(value))
+
+
+def _xdr_nvlist(pairs):
+    """Encode a list of name value pairs as an XDR nvlist.
+
+    Args:
+        pairs: A list of (name, value) tuples. Integer values are encoded as
+            uint64, strings as strings and lists as nested nvlists.
+
+    Returns:
+        The encoded nvlist, without the nvlist header.
+    """
+
+    data = struct.pack('>iI', 0, NV_UNIQUE_NAME)
+
+    for name, value in pairs:
+        if isinstance(value, list):
+            kind, encoded, decoded = DATA_TYPE_NVLIST, _xdr_nvlist(value), 24
+        elif isinstance(value, str):
+            kind, encoded = DATA_TYPE_STRING, _xdr_string(value)
+            decoded = _roundup(len(value) + 1, 8)
+        else:
+            kind, encoded, decoded = DATA_TYPE_UINT64, struct.pack('>Q',
+                                                                   value), 8
+
+        body = _xdr_string(name) + struct.pack('>ii', kind, 1) + encoded
+        decoded += _roundup(16 + len(name) + 1, 8)
+        data += struct.pack('>ii', len(body) + 8, decoded) + body
+
+    return data + struct.pack('>ii', 0, 0)
+
+
+def pack_nvlist(pairs):
+    """Pack a list of name value pairs as an XDR encoded nvlist.
+
+    Args:
+        pairs: A list of (name, value) tuples, see _xdr_nvlist.
+
+    Returns:
+        The packed nvlist.
+    """
+
+    return struct.pack('<BBBB', NV_ENCODE_XDR, 1, 0, 0) + _xdr_nvlist(pairs)
+
+
+def microzap(entries):
+    """Create the block of a micro ZAP.
+
+    Args:
+        entries: A list of (name, value) tuples.
+
+    Returns:
+        The data of the smallest micro ZAP block that holds the entries.
+
+    Raises:
+        ValueError: The entries do not fit in a micro ZAP.
+    """
+
+    size = SECTOR_SIZE
+
+    while size < MZAP_ENT_SIZE * (len(entries) + 1):
+        size *= 2
+
+    if size > MZAP_MAX_SIZE:
+        raise ValueError('Too many entries for a micro ZAP')
+
+    data = bytearray(size)
+    data[0:8] = struct.pack('<Q', ZBT_MICRO)
+
+    for ii, (name, value) in enumerate(entries):
+        if len(name) >= MZAP_NAME_LEN:
+            raise ValueError('ZAP entry name is too long')
+
+        pos = MZAP_ENT_SIZE * (ii + 1)
+        data[pos:pos + MZAP_ENT_SIZE] = struct.pack(
+            '<QIH50s', value, 0, 0, name)
+
+    return bytes(data)
+
+
+def dnode(kind, blkptrs=(), nlevels=1, datablksz=SECTOR_SIZE, maxblkid=0,
+          secphys=0, bonustype=0, bonus=b'', nblkptr=1):
+    """Create a dnode.
+
+    Args:
+        kind: The DMU object type of the dnode.
+        blkptrs: The block pointers of the top level of the object.
+        nlevels: The number of levels of blocks of the object.
+        datablksz: The size of the data blocks of the object.
+        maxblkid: The id of the last data block of the object.
+        secphys: The number of sectors allocated to the object.
+        bonustype: The DMU object type of the bonus buffer.
+        bonus: The bonus buffer.
+        nblkptr: The number of block pointers in the dnode.
+
+    Returns:
+        The 512 byte dnode.
+    """
+
+    data = bytearray(DNODE_SIZE)
+    data[0:64] = struct.pack(
+        '<8BHH4xQQ32x', kind, INDIRECT_SHIFT, nlevels, nblkptr, bonustype,
+        0, 0, 0, datablksz / SECTOR_SIZE, len(bonus), maxblkid, secphys)
+
+    for ii, blkptr in enumerate(blkptrs):
+        data[64 + ii * BLKPTR_SIZE:64 + (ii + 1) * BLKPTR_SIZE] = blkptr
+
+    pos = 64 + nblkptr * BLKPTR_SIZE
+    data[pos:pos + len(bonus)] = bonus
+
+    return bytes(data)
+
+
+def znode(mode, size, parent, links, created, modified):
+    """Create the znode bonus buffer of a ZPL object.
+
+    Args:
+        mode: The file mode.
+        size: The size of the file, or the entries in a directory.
+        parent: The object id of the parent directory.
+        links: The number of links to the object.
+        created: The txg the object was created in.
+        modified: The txg the object was last modified in.
+
+    Returns:
+        The 264 byte znode.
+    """
+
+    ctime = BASE_TIME + created * 5
+    mtime = BASE_TIME + modified * 5
+
+    return struct.pack('<22Q88x', mtime, 0, mtime, 0, mtime, 0, ctime,
+                       0, created, mode, size, parent, links, 0, 0, 0, 0, 0,
+                       0, 0, 0, 0)
+
+
+def space_map(extents, start, size):
+    """Create the entries of the space map of a metaslab.
+
+    The space map records every allocated extent within the metaslab as an
+    allocation, in sectors from the start of the metaslab.
+
+    Args:
+        extents: A sorted list of (offset, size) allocated extents, with
+            adjacent extents merged.
+        start: The offset of the metaslab.
+        size: The size of the metaslab.
+
+    Returns:
+        A tuple of (entries, allocated) with the packed entries and the
+        number of bytes allocated in the metaslab.
+    """
+
+    entries = []
+    allocated = 0
+
+    for offset, length in extents:
+        first = max(offset, start)
+        end = min(offset + length, start + size)
+
+        if first >= end:
+            continue
+
+        allocated += end - first
+        sector = (first - start) / SECTOR_SIZE
+        count = (end - first) / SECTOR_SIZE
+
+        while count:
+            run = min(count, SM_RUN_MAX)
+            entries.append(sector << 16 | run - 1)
+            sector += run
+            count -= run
+
+    return struct.pack('<{0}Q'.format(len(entries)), *entries), allocated
+
+
+def objset(metadnode, os_type):
+    """Create the block of an object set.
+
+    Args:
+        metadnode: The dnode of the objects of the object set.
+        os_type: The type of the object set.
+
+    Returns:
+        The 1K objset_phys block.
+    """
+
+    return metadnode + b'\0' * 192 + struct.pack('<Q', os_type) + \
+        b'\0' * 312
+
+
+def file_data(key, size):
+    """Generate the pseudo random contents of a file.
+
+    Args:
+        key: A string the contents are generated from.
+        size: The size of the contents in bytes.
+
+    Returns:
+        The contents of the file.
+    """
+
+    chunks = []
+    seed = hashlib.sha256(key).digest()
+
+    for ii in xrange(0, _roundup(size, 32) / 32):
+        chunks.append(hashlib.sha256(seed + struct.pack('<Q', ii)).digest())
+
+    return b''.join(chunks)[:size]
+
+
+class _File(object):
+    """A file of the generated file system."""
+
+    def __init__(self, obj_id, name, created):
+        self.obj_id = obj_id
+        self.name = name
+        self.created = created
+        self.modified = created
+        self.size = 0
+        self.digest = None
+        self.blkptrs = []
+        self.nlevels = 1
+        self.datablksz = SECTOR_SIZE
+        self.maxblkid = 0
+        self.secphys = 0
+        self.extents = []
+
+
+class PoolImage(object):
+    """Builds a synthetic ZFS version 1 pool image.
+
+    The pool has a single disk vdev holding one file system of plain files
+    in its root directory. Files are created, modified and removed between
+    calls to commit(), each of which writes a new txg the way ZFS does:
+    only the blocks that changed are written, to newly allocated space, and
+    a new uberblock is written to the labels. Space freed by a txg is only
+    reused once the space that was never allocated has run out, so the files
+    of earlier txgs remain on disk to be recovered for as long as possible.
+
+    Metadata blocks are LZJB compressed and checksummed with fletcher4, file
+    data is not compressed and is checksummed with fletcher2, as in a
+    version 1 pool with default properties.
+
+    The blocks a txg no longer refers to are freed in the space maps of the
+    metaslabs, which are rewritten with the MOS of every txg. Space freed by
+    a txg can be reused once the txg has been committed.
+
+    The unallocated space of the image can be filled with random noise so
+    that the brute method has data to reject.
+
+    Attributes:
+        seen: A dictionary of the digests of the contents of every file
+            committed in any txg to their names.
+    """
+
+    def __init__(self, path, size, seed=0, noise=0.0, name='bench'):
+        """Initialize PoolImage.
+
+        Args:
+            path: The path of the image file to create.
+            size: The size of the image in bytes.
+            seed: The seed of the random generator used for the image.
+            noise: The fraction of the unallocated space to fill with random
+                data.
+            name: The name of the pool.
+        """
+
+        self.path = path
+        self.size = size / LABEL_SIZE * LABEL_SIZE
+        self.name = name
+        self.random = random.Random(seed)
+        self.pool_guid = self.random.getrandbits(63)
+        self.vdev_guid = self.random.getrandbits(63)
+        self.fsid_guid = self.random.getrandbits(56)
+        self.asize = self.size - DATA_START - 2 * LABEL_SIZE
+        self.metaslab_shift = min(METASLAB_SHIFT,
+                                  (self.asize / METASLAB_SPLIT).bit_length())
+        self.ms_count = self.asize >> self.metaslab_shift
+        self.ms_end = self.ms_count << self.metaslab_shift
+        self.allocated = 0
+        self.allocations = []
+        self.extents = {}
+        self.temporary = []
+        self.free = []
+        self.freeing = []
+        self.reserve = None
+        self.txg = 3
+        self.next_obj = ZPL_FIRST_FILE
+        self.files = {}
+        self.seen = {}
+        self.dnode_blocks = {}
+        self.static = {}
+        self.file_ = open(path, 'w+b')
+        self.file_.truncate(self.size)
+        self._fill_noise(noise)
+
+    def close(self):
+        """Close the image file."""
+
+        self.file_.close()
+
+    def add_file(self, name, size):
+        """Create a file.
+
+        Args:
+            name: The name of the file.
+            size: The size of the file in bytes.
+        """
+
+        zfile = _File(self.next_obj, name, self.txg + 1)
+        self.next_obj += 1
+        self._write_file(zfile, size)
+        self.files[name] = zfile
+
+    def modify_file(self, name, size):
+        """Replace the contents of a file.
+
+        Args:
+            name: The name of the file.
+            size: The new size of the file in bytes.
+        """
+
+        zfile = self.files[name]
+        zfile.modified = self.txg + 1
+        self._write_file(zfile, size)
+
+    def remove_file(self, name):
+        """Remove a file.
+
+        Args:
+            name: The name of the file.
+        """
+
+        self._free(self.files.pop(name).extents)
+
+    def live(self):
+        """Retrieve the files of the last committed txg.
+
+        Returns:
+            A dictionary of the digests of the contents of the files to
+            their names.
+        """
+
+        return dict((zfile.digest, name)
+                    for name, zfile in self.files.items())
+
+    def commit(self):
+        """Write the changes made since the last commit as a new txg.
+
+        Returns:
+            The txg that was written.
+        """
+
+        self.txg += 1
+
+        if not self.static:
+            self._write_static()
+
+        # The blocks rewritten by every txg are freed by the next one.
+        self._free(self.temporary)
+        start = len(self.allocations)
+
+        zpl_blkptr = self._write_zpl()
+        mos_blkptr = self._write_mos(zpl_blkptr)
+        self._write_uberblock(mos_blkptr)
+
+        kept = set(extent for _, _, extent in self.dnode_blocks.values())
+        self.temporary = [extent for extent in self.allocations[start:]
+                          if extent not in kept]
+        self._release_frees()
+
+        for name, zfile in self.files.items():
+            self.seen.setdefault(zfile.digest, name)
+
+        return self.txg
+
+    def _fill_noise(self, noise):
+        """Fill part of the allocatable space with random data.
+
+        Args:
+            noise: The fraction of the space to fill.
+        """
+
+        chunk = 65536
+        pool = bytearray(self.random.getrandbits(8) for _ in xrange(chunk))
+        pool = bytes(pool) * 2
+
+        for offset in xrange(0, self.asize, chunk):
+            if self.random.random() >= noise:
+                continue
+
+            start = self.random.randrange(chunk)
+            self.file_.seek(DATA_START + offset)
+            self.file_.write(pool[start:start + min(chunk,
+                                                    self.asize - offset)])
+
+    def _alloc(self, size):
+        """Allocate space for a block.
+
+        Only the space covered by the metaslabs is allocated. Space that was
+        never allocated is used first, then the first freed extent that is
+        large enough. While the MOS of a txg is written, space is taken from
+        the space reserved for it by _write_space_maps().
+
+        Args:
+            size: The size of the block in bytes.
+
+        Returns:
+            The offset of the space from the start of the allocatable space.
+
+        Raises:
+            ValueError: The image is full, or the MOS does not fit in its
+                reserved space.
+        """
+
+        if self.reserve is not None:
+            offset, end = self.reserve
+
+            if offset + size > end:
+                raise ValueError('MOS does not fit in the space map reserve')
+
+            self.reserve = (offset + size, end)
+            return offset
+
+        if self.allocated + size <= self.ms_end:
+            offset = self.allocated
+            self.allocated += size
+        else:
+            for ii, (offset, length) in enumerate(self.free):
+                if length >= size:
+                    break
+            else:
+                raise ValueError('Image is full')
+
+            if length == size:
+                del self.free[ii]
+            else:
+                self.free[ii] = (offset + size, length - size)
+
+        self.allocations.append((offset, size))
+        self.extents[offset] = size
+        return offset
+
+    def _free(self, extents):
+        """Free the space of blocks.
+
+        The space can be reused once the current txg has been committed.
+
+        Args:
+            extents: A list of the (offset, size) extents of the blocks.
+        """
+
+        for offset, size in extents:
+            del self.extents[offset]
+            self.freeing.append((offset, size))
+
+    def _release_frees(self):
+        """Make the space freed by the committed txg available again."""
+
+        merged = []
+
+        for offset, size in sorted(self.free + self.freeing):
+            if merged and merged[-1][0] + merged[-1][1] == offset:
+                merged[-1] = (merged[-1][0], merged[-1][1] + size)
+            else:
+                merged.append((offset, size))
+
+        self.free = merged
+        self.freeing = []
+
+    def _write_block(self, data, kind, level=0, fill=1, metadata=True):
+        """Write a block to newly allocated space.
+
+        Args:
+            data: The data of the block, a multiple of 512 bytes long.
+            kind: The DMU object type of the block.
+            level: The level of the block in its object.
+            fill: The number of non empty blocks or dnodes the block refers
+                to.
+            metadata: If True the block is compressed and checksummed as
+                metadata.
+
+        Returns:
+            The block pointer of the block.
+        """
+
+        lsize = len(data)
+        payload = data
+        compress = COMPRESS_OFF
+
+        if metadata:
+            compressed = lzjb_compress(data)
+
+            if compressed and _roundup(len(compressed), SECTOR_SIZE) < lsize:
+                payload = compressed + b'\0' * (
+                    _roundup(len(compressed), SECTOR_SIZE) - len(compressed))
+                compress = COMPRESS_LZJB
+
+        psize = len(payload)
+        offset = self._alloc(psize)
+        self.file_.seek(DATA_START + offset)
+        self.file_.write(payload)
+
+        if metadata:
+            checksum_type = CHECKSUM_FLETCHER_4
+            checksum = fletcher4(payload)
+        else:
+            checksum_type = CHECKSUM_FLETCHER_2
+            checksum = fletcher2(payload)
+
+        dva = struct.pack('<QQ', psize / SECTOR_SIZE, offset / SECTOR_SIZE)
+        prop = ((lsize / SECTOR_SIZE - 1) |
+                (psize / SECTOR_SIZE - 1) << 16 |
+                compress << 32 | checksum_type << 40 | kind << 48 |
+                level << 56 | 1 << 63)
+
+        return (dva + b'\0' * 32 + struct.pack('<Q', prop) + b'\0' * 24 +
+                struct.pack('<QQ4Q', self.txg, fill, *checksum))
+
+    def _write_tree(self, blkptrs, fills, kind, nblkptr):
+        """Write the indirect blocks of an object.
+
+        Args:
+            blkptrs: The block pointers of the data blocks of the object.
+            fills: The fill counts of the data blocks.
+            kind: The DMU object type of the object.
+            nblkptr: The number of block pointers in the dnode.
+
+        Returns:
+            A tuple of (blkptrs, nlevels) with the block pointers of the top
+            level, padded to nblkptr, and the number of levels.
+        """
+
+        per_block = 1 << (INDIRECT_SHIFT - 7)
+        level = 0
+
+        while len(blkptrs) > nblkptr:
+            level += 1
+            parents = []
+            parent_fills = []
+
+            for ii in xrange(0, len(blkptrs), per_block):
+                children = blkptrs[ii:ii + per_block]
+                fill = sum(fills[ii:ii + per_block])
+                data = b''.join(children)
+                data += b'\0' * ((1 << INDIRECT_SHIFT) - len(data))
+                parents.append(self._write_block(data, kind, level, fill))
+                parent_fills.append(fill)
+
+            blkptrs, fills = parents, parent_fills
+
+        blkptrs = list(blkptrs) + [EMPTY_BLKPTR] * (nblkptr - len(blkptrs))
+        return blkptrs, level + 1
+
+    def _write_file(self, zfile, size):
+        """Write new contents for a file.
+
+        Args:
+            zfile: The _File to write.
+            size: The size of the contents in bytes.
+        """
+
+        key = '{0}-{1}-{2}'.format(self.pool_guid, zfile.name,
+                                   zfile.modified)
+        data = file_data(key, size)
+
+        self._free(zfile.extents)
+        start = len(self.allocations)
+
+        if size <= RECORD_SIZE:
+            blksz = max(_roundup(size, SECTOR_SIZE), SECTOR_SIZE)
+        else:
+            blksz = RECORD_SIZE
+
+        blkptrs = []
+
+        for pos in xrange(0, max(size, 1), blksz):
+            block = data[pos:pos + blksz]
+            block += b'\0' * (blksz - len(block))
+            blkptrs.append(self._write_block(block, OT_PLAIN_FILE_CONTENTS,
+                                             metadata=False))
+
+        zfile.size = size
+        zfile.digest = hashlib.sha256(data).hexdigest()
+        zfile.datablksz = blksz
+        zfile.maxblkid = len(blkptrs) - 1
+        zfile.blkptrs, zfile.nlevels = self._write_tree(
+            blkptrs, [1] * len(blkptrs), OT_PLAIN_FILE_CONTENTS, 1)
+        zfile.secphys = len(blkptrs) * blksz / SECTOR_SIZE
+        zfile.extents = self.allocations[start:]
+
+    def _write_static(self):
+        """Write the blocks of objects that do not change between txgs."""
+
+        self.static['master_node'] = self._write_block(
+            microzap([('VERSION', ZPL_VERSION),
+                      ('ROOT', ZPL_ROOT),
+                      ('DELETE_QUEUE', ZPL_DELETE_QUEUE)]), OT_MASTER_NODE)
+        self.static['delete_queue'] = self._write_block(microzap([]),
+                                                        OT_DELETE_QUEUE)
+        self.static['object_directory'] = self._write_block(
+            microzap([('root_dataset', MOS_DSL_DIR),
+                      ('config', MOS_CONFIG)]), OT_OBJECT_DIRECTORY)
+
+        config = pack_nvlist(self._config())
+        self.static['config_size'] = len(config)
+        self.static['config'] = self._write_block(
+            config + b'\0' * (_roundup(len(config), SECTOR_SIZE) -
+                              len(config)), OT_PACKED_NVLIST)
+
+        for name, kind in (('child_map', OT_DSL_DIR_CHILD_MAP),
+                           ('props', OT_DSL_PROPS),
+                           ('snap_map', OT_DSL_DS_SNAP_MAP)):
+            self.static[name] = self._write_block(microzap([]), kind)
+
+        self.static['created'] = self.txg
+        self._write_labels()
+
+    def _config(self):
+        """Create the pool configuration.
+
+        Returns:
+            A list of the name value pairs of the configuration.
+        """
+
+        vdev_tree = [
+            ('type', 'disk'),
+            ('id', 0),
+            ('guid', self.vdev_guid),
+            ('path', '/dev/dsk/{0}'.format(self.name)),
+            ('whole_disk', 0),
+            ('metaslab_array', MOS_METASLAB_ARRAY),
+            ('metaslab_shift', self.metaslab_shift),
+            ('ashift', 9),
+            ('asize', self.asize),
+            ]
+
+        return [
+            ('version', SPA_VERSION),
+            ('name', self.name),
+            ('state', 0),
+            ('txg', self.txg),
+            ('pool_guid', self.pool_guid),
+            ('top_guid', self.vdev_guid),
+            ('guid', self.vdev_guid),
+            ('vdev_tree', vdev_tree),
+            ]
+
+    def _label_offsets(self):
+        """Retrieve the offsets of the four vdev labels."""
+
+        return (0, LABEL_SIZE, self.size - 2 * LABEL_SIZE,
+                self.size - LABEL_SIZE)
+
+    def _write_labeled(self, offset, data):
+        """Write a block with an embedded label checksum.
+
+        Args:
+            offset: The offset of the block on the disk.
+            data: The data of the block, without the checksum tail.
+        """
+
+        tail = struct.pack('<Q4Q', ZEC_MAGIC, offset, 0, 0, 0)
+        digest = hashlib.sha256(data + tail).digest()
+        checksum = struct.unpack('>4Q', digest)
+        self.file_.seek(offset)
+        self.file_.write(data + struct.pack('<Q4Q', ZEC_MAGIC, *checksum))
+
+    def _write_labels(self):
+        """Write the configuration nvlist of the vdev labels."""
+
+        config = pack_nvlist(self._config())
+        config += b'\0' * (VDEV_PHYS_SIZE - 40 - len(config))
+
+        for label in self._label_offsets():
+            self._write_labeled(label + VDEV_PHYS_OFFSET, config)
+
+    def _write_zpl(self):
+        """Write the file system of the current txg.
+
+        Returns:
+            The block pointer of the ZPL object set.
+        """
+
+        files = sorted(self.files.values(), key=lambda zfile: zfile.name)
+        entries = microzap([(zfile.name, DT_REG << 60 | zfile.obj_id)
+                            for zfile in files])
+        root = self._write_block(entries, OT_DIRECTORY_CONTENTS)
+
+        dnodes = [b'\0' * DNODE_SIZE] * max(self.next_obj, ZPL_FIRST_FILE)
+        dnodes[ZPL_MASTER_NODE] = dnode(OT_MASTER_NODE,
+                                        [self.static['master_node']])
+        dnodes[ZPL_DELETE_QUEUE] = dnode(OT_DELETE_QUEUE,
+                                         [self.static['delete_queue']])
+        dnodes[ZPL_ROOT] = dnode(
+            OT_DIRECTORY_CONTENTS, [root],
+            datablksz=len(entries),
+            bonustype=OT_ZNODE,
+            bonus=znode(S_IFDIR | 0o755, len(files) + 2, ZPL_ROOT, 2,
+                        self.static['created'], self.txg))
+
+        for zfile in files:
+            dnodes[zfile.obj_id] = dnode(
+                OT_PLAIN_FILE_CONTENTS, zfile.blkptrs, zfile.nlevels,
+                zfile.datablksz, zfile.maxblkid, zfile.secphys, OT_ZNODE,
+                znode(S_IFREG | 0o644, zfile.size, ZPL_ROOT, 1,
+                      zfile.created, zfile.modified))
+
+        blkptrs, fills = self._write_dnodes(dnodes, self.dnode_blocks)
+        return self._write_objset(blkptrs, fills, OST_ZFS)
+
+    def _write_mos(self, zpl_blkptr):
+        """Write the meta object set of the current txg.
+
+        Args:
+            zpl_blkptr: The block pointer of the ZPL object set.
+
+        Returns:
+            The block pointer of the MOS.
+        """
+
+        now = BASE_TIME + self.txg * 5
+        dsl_dir = struct.pack('<11Q168x', now, MOS_DSL_DATASET, 0, 0,
+                              MOS_CHILD_MAP, 0, 0, 0, 0, 0, MOS_PROPS)
+        dsl_dataset = struct.pack(
+            '<16Q', MOS_DSL_DIR, 0, 0, 0, MOS_SNAP_MAP, 0,
+            BASE_TIME + self.static['created'] * 5, self.static['created'],
+            0, 0, 0, 0, 0, self.fsid_guid, self.pool_guid, 0)
+        dsl_dataset += zpl_blkptr + b'\0' * 64
+
+        dnodes = [b'\0' * DNODE_SIZE] * MOS_FIRST_SPACE_MAP
+        dnodes[MOS_OBJECT_DIRECTORY] = dnode(
+            OT_OBJECT_DIRECTORY, [self.static['object_directory']])
+        dnodes[MOS_DSL_DIR] = dnode(OT_DSL_DIR, bonustype=OT_DSL_DIR,
+                                    bonus=dsl_dir)
+        dnodes[MOS_CONFIG] = dnode(
+            OT_PACKED_NVLIST, [self.static['config']],
+            datablksz=_roundup(self.static['config_size'], SECTOR_SIZE),
+            bonustype=OT_PACKED_NVLIST_SIZE,
+            bonus=struct.pack('<Q', self.static['config_size']))
+        dnodes[MOS_DSL_DATASET] = dnode(OT_DSL_DATASET,
+                                        bonustype=OT_DSL_DATASET,
+                                        bonus=dsl_dataset)
+        dnodes[MOS_CHILD_MAP] = dnode(OT_DSL_DIR_CHILD_MAP,
+                                      [self.static['child_map']])
+        dnodes[MOS_PROPS] = dnode(OT_DSL_PROPS, [self.static['props']])
+        dnodes[MOS_SNAP_MAP] = dnode(OT_DSL_DS_SNAP_MAP,
+                                     [self.static['snap_map']])
+        self._write_space_maps(dnodes)
+
+        blkptrs, fills = self._write_dnodes(dnodes, {})
+        mos_blkptr = self._write_objset(blkptrs, fills, OST_META)
+        self.reserve = None
+
+        return mos_blkptr
+
+    def _write_space_maps(self, dnodes):
+        """Write the space maps of the metaslabs and the metaslab array.
+
+        Space for the MOS of the txg is allocated before the space maps are
+        made, and the space maps and the rest of the MOS are written into it
+        until _write_mos() has finished, so that the space maps cover every
+        block of the txg.
+
+        Args:
+            dnodes: The list of the dnodes of the MOS to add the objects to.
+        """
+
+        start = self._alloc(SPACE_MAP_RESERVE)
+        extents = []
+
+        for offset, size in sorted(self.extents.items()):
+            if extents and extents[-1][0] + extents[-1][1] == offset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + size)
+            else:
+                extents.append((offset, size))
+
+        self.reserve = (start, start + SPACE_MAP_RESERVE)
+        ms_size = 1 << self.metaslab_shift
+        ms_array = []
+
+        for ms_id in xrange(self.ms_count):
+            entries, allocated = space_map(extents, ms_id * ms_size, ms_size)
+
+            if not entries:
+                ms_array.append(0)
+                continue
+
+            obj_id = MOS_FIRST_SPACE_MAP + ms_id
+            blkptrs = []
+
+            for pos in xrange(0, len(entries), SPACE_MAP_BLOCK):
+                block = entries[pos:pos + SPACE_MAP_BLOCK]
+                block += b'\0' * (SPACE_MAP_BLOCK - len(block))
+                blkptrs.append(self._write_block(block, OT_SPACE_MAP))
+
+            top, nlevels = self._write_tree(blkptrs, [1] * len(blkptrs),
+                                            OT_SPACE_MAP, 1)
+            dnodes.extend([b'\0' * DNODE_SIZE] * (obj_id + 1 - len(dnodes)))
+            dnodes[obj_id] = dnode(
+                OT_SPACE_MAP, top, nlevels, SPACE_MAP_BLOCK,
+                len(blkptrs) - 1, bonustype=OT_SPACE_MAP_HEADER,
+                bonus=struct.pack('<3Q', obj_id, len(entries), allocated))
+            ms_array.append(obj_id)
+
+        array = struct.pack('<{0}Q'.format(len(ms_array)), *ms_array)
+        array += b'\0' * (_roundup(len(array), SECTOR_SIZE) - len(array))
+        dnodes[MOS_METASLAB_ARRAY] = dnode(
+            OT_OBJECT_ARRAY, [self._write_block(array, OT_OBJECT_ARRAY)],
+            datablksz=len(array))
+
+    def _write_dnodes(self, dnodes, written):
+        """Write the blocks of dnodes of an object set.
+
+        Blocks that are unchanged since they were last written are not
+        written again.
+
+        Args:
+            dnodes: A list of the dnodes of the object set, by object id.
+            written: A dictionary of (data, blkptr, extent) tuples of the
+                blocks of the object set written so far, by block id,
+                updated with the blocks written. The space of a block that
+                is written again is freed.
+
+        Returns:
+            A tuple of (blkptrs, fills) of the blocks of dnodes.
+        """
+
+        per_block = DNODE_BLOCK / DNODE_SIZE
+        blkptrs = []
+        fills = []
+
+        for blkid in xrange(0, _roundup(len(dnodes), per_block) / per_block):
+            block = dnodes[blkid * per_block:(blkid + 1) * per_block]
+            fill = sum(1 for data in block if data[0:1] != b'\0')
+            data = b''.join(block)
+            data += b'\0' * (DNODE_BLOCK - len(data))
+
+            if blkid not in written or written[blkid][0] != data:
+                if blkid in written:
+                    self._free([written[blkid][2]])
+
+                blkptr = self._write_block(data, OT_DNODE, fill=fill)
+                written[blkid] = (data, blkptr, self.allocations[-1])
+
+            blkptrs.append(written[blkid][1])
+            fills.append(fill)
+
+        return blkptrs, fills
+
+    def _write_objset(self, blkptrs, fills, os_type):
+        """Write an object set.
+
+        Args:
+            blkptrs: The block pointers of the blocks of dnodes.
+            fills: The fill counts of the blocks of dnodes.
+            os_type: The type of the object set.
+
+        Returns:
+            The block pointer of the object set.
+        """
+
+        top, nlevels = self._write_tree(blkptrs, fills, OT_DNODE, 3)
+        metadnode = dnode(OT_DNODE, top, nlevels, DNODE_BLOCK,
+                          len(blkptrs) - 1, nblkptr=3)
+
+        return self._write_block(objset(metadnode, os_type), OT_OBJSET,
+                                 fill=sum(fills))
+
+    def _write_uberblock(self, rootbp):
+        """Write the uberblock of the current txg to the vdev labels.
+
+        Args:
+            rootbp: The block pointer of the MOS.
+        """
+
+        guid_sum = (self.pool_guid + self.vdev_guid) & ((1 << 64) - 1)
+        data = struct.pack('<5Q', UBERBLOCK_MAGIC, SPA_VERSION, self.txg,
+                           guid_sum, BASE_TIME + self.txg * 5) + rootbp
+        data += b'\0' * (UBERBLOCK_SIZE - 40 - len(data))
+        slot = UBERBLOCK_OFFSET + self.txg % UBERBLOCK_COUNT * UBERBLOCK_SIZE
+
+        for label in self._label_offsets():
+            self._write_labeled(label + slot, data)
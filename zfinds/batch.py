@@ -0,0 +1,242 @@
+import collections
+import hashlib
+import logging
+import multiprocessing
+import os
+import Queue
+
+from .stats import STATS
+
+BATCH_POLL = 1  # Seconds between checks for images whose process died
+
+_READ_SIZE = 1048576  # Read recovered files 1M at a time when deduping
+
+
+def read_manifest(path):
+    """Read the paths of the disk images listed in a manifest.
+
+    A manifest lists one disk image per line. Blank lines and lines starting
+    with # are ignored, and relative paths are relative to the directory of
+    the manifest.
+
+    Args:
+        path: The path of the manifest.
+
+    Returns:
+        A list of the paths of the disk images, in the order listed.
+    """
+
+    base = os.path.dirname(os.path.abspath(path))
+    images = []
+
+    with open(path) as file_:
+        for line in file_:
+            line = line.strip()
+
+            if line and not line.startswith('#'):
+                images.append(os.path.join(base, line))
+
+    return images
+
+
+def image_destinations(images, destination):
+    """Create the output directory names of a batch of disk images.
+
+    Each image is given a subdirectory of the destination named after the
+    file name of the image. Images with the same file name are told apart
+    by a number appended to the names after the first.
+
+    Args:
+        images: A list of the paths of the disk images.
+        destination: The directory to create the subdirectories in.
+
+    Returns:
+        A list of the output directory of each image.
+    """
+
+    names = collections.Counter()
+    destinations = []
+
+    for image in images:
+        name = os.path.basename(os.path.normpath(image))
+        names[name] += 1
+
+        if names[name] > 1:
+            name = '{0}-{1}'.format(name, names[name])
+
+        destinations.append(os.path.join(destination, name))
+
+    return destinations
+
+
+def _run_image(results, index, run, image, destination, kwargs):
+    """Recover the files of a disk image in a batch process.
+
+    Args:
+        results: The multiprocessing.Queue to put the result in.
+        index: The position of the image in the batch.
+        run: The function to run the recovery with.
+        image: The path of the disk image.
+        destination: The output directory of the image.
+        kwargs: Other keyword arguments to call run with.
+    """
+
+    STATS.reset()
+    STATS.label = os.path.basename(destination)
+    error = None
+
+    try:
+        run(disk=image, destination=destination, **kwargs)
+    except Exception as exc:
+        logging.getLogger(__name__).exception('Recovery of %s failed', image)
+        error = str(exc) or exc.__class__.__name__
+
+    results.put((index, error, STATS.report()))
+
+
+def run_batch(images, destinations, run, kwargs, workers=1):
+    """Recover the files of several disk images.
+
+    Every image is recovered by its own process, forked from this one so
+    that the modules already loaded do not have to be loaded again, and so
+    that nothing the recovery of an image changes in its process is seen by
+    the other images. Up to the given number of images are recovered at
+    once. The processes are not daemonic, so that they can start the worker
+    processes of the recovery methods.
+
+    Args:
+        images: A list of the paths of the disk images.
+        destinations: A list of the output directory of each image.
+        run: The function to run the recovery with. It is called with the
+            image as disk, its destination and the other keyword arguments.
+        kwargs: The other keyword arguments to call run with.
+        workers: The number of images to recover at once.
+
+    Returns:
+        A list of (image, error, report) tuples in the order of the images.
+        error is None if the recovery completed, and report is the Stats
+        report of the recovery, or None if its process died without one.
+    """
+
+    results = multiprocessing.Queue()
+    pending = collections.deque(enumerate(zip(images, destinations)))
+    running = {}
+    done = {}
+    log = logging.getLogger(__name__)
+
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                index, (image, destination) = pending.popleft()
+                log.info('Recovering %s to %s', image, destination)
+                process = multiprocessing.Process(
+                    target=_run_image,
+                    args=(results, index, run, image, destination, kwargs))
+                process.start()
+                running[index] = process
+
+            try:
+                index, error, report = results.get(timeout=BATCH_POLL)
+            except Queue.Empty:
+                # A process that exited without a result will never send
+                # one. A result that still arrives replaces the failure.
+                for index, process in running.items():
+                    if process.exitcode is not None:
+                        process.join()
+                        done[index] = ('exit code {0}'.format(
+                            process.exitcode), None)
+                        del running[index]
+                continue
+
+            process = running.pop(index, None)
+
+            if process is not None:
+                process.join()
+
+            done[index] = (error, report)
+
+        while True:
+            try:
+                index, error, report = results.get_nowait()
+            except Queue.Empty:
+                break
+
+            done[index] = (error, report)
+    finally:
+        for process in running.values():
+            process.terminate()
+            process.join()
+
+    return [(image,) + done.get(index, ('no result', None))
+            for index, image in enumerate(images)]
+
+
+def dedupe_outputs(destinations, algorithm='sha256'):
+    """Remove recovered files that were also recovered from an earlier image.
+
+    Files are compared in the order of the destinations, so the copy that
+    is kept is the one recovered from the first image it was found in.
+    Only files whose size matches another file are hashed. Temporary files
+    and journals left in the destinations are not compared.
+
+    Args:
+        destinations: A list of the output directories of the images.
+        algorithm: The name of the hashlib algorithm to compare files with.
+
+    Returns:
+        The number of files removed.
+    """
+
+    by_size = collections.defaultdict(list)
+
+    for destination in destinations:
+        if not os.path.isdir(destination):
+            continue
+
+        for file_name in sorted(os.listdir(destination)):
+            path = os.path.join(destination, file_name)
+
+            if file_name.startswith('.zfinds-') or not os.path.isfile(path):
+                continue
+
+            by_size[os.path.getsize(path)].append((destination, path))
+
+    removed = 0
+
+    for files in by_size.values():
+        if len(set(destination for destination, _ in files)) < 2:
+            continue
+
+        seen = {}
+
+        for destination, path in files:
+            digest = _file_digest(path, algorithm)
+            first = seen.setdefault(digest, destination)
+
+            if first != destination:
+                os.unlink(path)
+                removed += 1
+
+    STATS.add('files_duplicate_images', removed)
+
+    return removed
+
+
+def _file_digest(path, algorithm):
+    """Hash the contents of a recovered file.
+
+    Args:
+        path: The path of the file.
+        algorithm: The name of the hashlib algorithm to hash it with.
+
+    Returns:
+        A hex digest of the contents of the file.
+    """
+
+    file_hash = hashlib.new(algorithm)
+
+    with open(path, 'rb') as file_:
+        for data in iter(lambda: file_.read(_READ_SIZE), b''):
+            file_hash.update(data)
+
+    return file_hash.hexdigest()
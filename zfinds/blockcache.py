@@ -0,0 +1,108 @@
+import threading
+
+from collections import OrderedDict
+from functools import wraps
+
+from .utils import OT_PLAIN_FILE_CONTENTS, get_blkptr_key, get_blkptr_props
+
+BLOCK_CACHE_SIZE = 268435456  # 256M of decompressed blocks
+
+
+class BlockCache(object):
+    """Caches blocks read from a ZFS pool.
+
+    The BlockCache is used to replace the callable function
+    zfspy.zio.ZIO.read_blk. Blocks are cached by the DVAs and birth txg of
+    their block pointer, so a block that is read again, whether by the same
+    pool load or by the load of another txg that shares it, is returned from
+    memory instead of being read and decompressed again. Once the cached
+    blocks exceed the maximum size the least recently used blocks are
+    evicted.
+
+    Only metadata is cached. The data blocks of files are read once or twice
+    while they are hashed and written, and would otherwise evict the object
+    set, directory and indirect blocks that are read by every pool load.
+    They are passed to the decorated function without taking the lock, as
+    are holes, which all have the same DVAs and birth txg.
+
+    Attributes:
+        hits: The number of reads returned from the cache.
+        misses: The number of reads passed to the decorated function.
+    """
+
+    def __init__(self, func, max_size=BLOCK_CACHE_SIZE):
+        """Initialize BlockCache.
+
+        Args:
+            func: The function that is being decorated.
+            max_size: The maximum number of bytes of blocks to cache.
+        """
+
+        self.func = func
+        self.max_size = max_size
+        self.size = 0
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        wraps(func)(self)
+
+    def __call__(self, vdev, blkptr, *args, **kwargs):
+        """Return the block from the cache or call the decorated function.
+
+        Args:
+            vdev: The VDev to read from.
+            blkptr: The block pointer of the block to read.
+
+        Returns:
+            The data of the block.
+        """
+
+        level, kind = get_blkptr_props(blkptr.raw)
+        key = get_blkptr_key(blkptr.raw)
+
+        if key is None or (level == 0 and kind == OT_PLAIN_FILE_CONTENTS):
+            return self.func(vdev, blkptr, *args, **kwargs)
+
+        with self.lock:
+            data = self.blocks.pop(key, None)
+
+            if data is not None:
+                self.blocks[key] = data
+                self.hits += 1
+                return data
+
+            self.misses += 1
+
+        data = self.func(vdev, blkptr, *args, **kwargs)
+
+        if len(data) <= self.max_size:
+            self._insert(key, data)
+
+        return data
+
+    def _insert(self, key, data):
+        """Add a block to the cache, evicting blocks as needed.
+
+        Args:
+            key: The key of the block.
+            data: The data of the block.
+        """
+
+        with self.lock:
+            if key in self.blocks:
+                return
+
+            self.blocks[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_size:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        """Remove all blocks from the cache."""
+
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
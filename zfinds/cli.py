@@ -1,16 +1,47 @@
+import json
 import logging
+import os
 import click
 
+from .batch import (
+    dedupe_outputs,
+    image_destinations,
+    read_manifest,
+    run_batch,
+    )
 from .zfinds import Zfinds
 from .zfilewriter import ZFileWriter
+from .blockcache import BLOCK_CACHE_SIZE
+from .readahead import READ_AHEAD
+from .stats import STATS
+from .zfilehash import DIGESTS
+from .utils import SCAN_WINDOW
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'zfinds')
+
 
 @click.command(context_settings=CONTEXT_SETTINGS, options_metavar='<options>')
 @click.argument('method', metavar='<method>',
                 type=click.Choice(['all', 'brute', 'uber']))
-@click.argument('disk', metavar='<path to disk>')
+@click.argument('disks', metavar='<path to disk>...', nargs=-1)
+@click.option('--manifest', default=None, metavar='<file>',
+              help='file listing the paths of disk images to recover, one '
+              'per line',
+              type=click.Path(exists=True, dir_okay=False,
+                              resolve_path=True))
+@click.option('--batch-jobs', default=1, metavar='<jobs>', show_default=True,
+              type=click.IntRange(min=1),
+              help='number of disk images to recover at once when several '
+              'are given; the jobs, hash jobs, write jobs and block cache '
+              'are shared between them')
+@click.option('--dedupe-images/--no-dedupe-images', default=False,
+              show_default=True,
+              help='If True, files recovered from several disk images are '
+              'only kept for the first image they were recovered from')
 @click.option('-d', '--destination', default='/tmp/zfinds', metavar='<dest>',
               show_default=True, help='location to save recovered files',
               type=click.Path(file_okay=False, writable=True,
@@ -18,10 +49,87 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 @click.option('--cache/--no-cache', default=True, show_default=True,
               help='If True, enables creating a cache of existing files '
               'before running recovery to prevent them from being found')
+@click.option('--cache-dir', default=CACHE_DIR, metavar='<dir>',
+              show_default=True, help='location to save the cache of '
+              'existing files in so later runs against the same pool can '
+              'reuse it',
+              type=click.Path(file_okay=False, resolve_path=True))
+@click.option('--save-cache/--no-save-cache', default=False,
+              show_default=True,
+              help='If True, saves the cache of existing files and reuses '
+              'a saved cache when it matches the pool. A saved cache holds '
+              'a bit for every sector of the disk')
+@click.option('--space-maps/--no-space-maps', default=False,
+              show_default=True,
+              help='If True, the brute method scans the sectors the space '
+              'maps of the pool record as free instead of the sectors not '
+              'read while building the cache of existing files')
+@click.option('-w', '--window-size', default=SCAN_WINDOW, metavar='<bytes>',
+              show_default=True, type=click.IntRange(min=512),
+              help='number of bytes to read from disk at a time during the '
+              'brute method')
+@click.option('--mmap/--no-mmap', 'use_mmap', default=False,
+              show_default=True,
+              help='If True, memory maps the disk during the brute method '
+              'instead of reading it')
+@click.option('-j', '--jobs', default=1, metavar='<jobs>', show_default=True,
+              type=click.IntRange(min=1),
+              help='number of processes to use during the uber and brute '
+              'methods')
+@click.option('--map-dir', default=None, metavar='<dir>',
+              help='directory to memory map the sector map in instead of '
+              'keeping it in memory',
+              type=click.Path(exists=True, file_okay=False, writable=True,
+                              resolve_path=True))
+@click.option('--block-cache', default=BLOCK_CACHE_SIZE, metavar='<bytes>',
+              show_default=True, type=click.IntRange(min=0),
+              help='maximum number of bytes of blocks to cache while walking '
+              'the file system, 0 disables the cache')
+@click.option('--digest', default='sha256', show_default=True,
+              type=click.Choice(DIGESTS),
+              help='hash algorithm used to compare file contents')
+@click.option('--exclude-by', default='identity', show_default=True,
+              type=click.Choice(['identity', 'content']),
+              help='how existing files are kept out of the results: by the '
+              'checksums of their block pointers, reading an existing file '
+              'only when a found file of its size differs, or by also '
+              'comparing the contents of existing files with each other')
+@click.option('--hash-jobs', default=1, metavar='<jobs>', show_default=True,
+              type=click.IntRange(min=1),
+              help='number of threads to hash file contents with')
+@click.option('--pipeline/--no-pipeline', default=False, show_default=True,
+              help='If True, writes recovered files as they are found '
+              'instead of after each recovery method has finished')
+@click.option('--single-read/--no-single-read', default=False,
+              show_default=True,
+              help='If True, saves found files to the destination while '
+              'they are hashed so they are not read from disk twice')
+@click.option('--write-jobs', default=1, metavar='<jobs>', show_default=True,
+              type=click.IntRange(min=1),
+              help='number of threads to write recovered files with')
+@click.option('--read-ahead', default=READ_AHEAD, metavar='<depth>',
+              show_default=True, type=click.IntRange(min=0),
+              help='number of file blocks and brute scan windows to read '
+              'ahead in a thread while the current one is used, 0 to read '
+              'without a thread')
+@click.option('--resume/--no-resume', default=False, show_default=True,
+              help='If True, continues an interrupted brute method from the '
+              'journal it left in the destination')
+@click.option('--progress/--no-progress', default=True, show_default=True,
+              help='If True, periodically writes the progress of the uber '
+              'and brute methods with an estimated time remaining to stderr')
+@click.option('--stats-json', default=None, metavar='<path>',
+              help='file to write counters and timings of the run to as JSON',
+              type=click.Path(dir_okay=False, writable=True,
+                              resolve_path=True))
 @click.option('-v', '--log-level', default='WARN',
               type=click.Choice(['DEBUG', 'INFO', 'WARN', 'ERROR']),
               show_default=True, help='logging level to use')
-def cli(disk, method, destination, cache, log_level):
+def cli(disks, method, manifest, batch_jobs, dedupe_images, destination,
+        cache, cache_dir, save_cache, space_maps, window_size, use_mmap,
+        jobs, map_dir, block_cache, digest, exclude_by, hash_jobs, pipeline,
+        single_read, write_jobs, read_ahead, resume, progress,
+        stats_json, log_level):
     """
     ZFindS is a command line tool that can be used to attempt to recover
     previous versions of files on disk, or files that have been deleted but yet
@@ -67,6 +175,14 @@ def cli(disk, method, destination, cache, log_level):
         found via either method will have their access and
         modify times updated to what they were on the file
         system that is being scanned.
+
+    Batches:
+
+        \b
+        Several disks, or a manifest listing them, may be
+        given. Each disk is then recovered by its own
+        process into a subdirectory of the destination
+        named after the disk.
     """
 
     # Set root logging configuration
@@ -78,16 +194,122 @@ def cli(disk, method, destination, cache, log_level):
     logger.addHandler(handler)
     logger.setLevel(log_level)
 
-    zfilewriter = ZFileWriter(destination)
-    zfinds = Zfinds(disk, zfilewriter)
+    STATS.show_progress = progress
+
+    images = list(disks)
+
+    if manifest:
+        images.extend(read_manifest(manifest))
+
+    if not images:
+        raise click.UsageError('No disk given')
+
+    kwargs = dict(method=method, cache=cache, cache_dir=cache_dir,
+                  save_cache=save_cache, space_maps=space_maps,
+                  window_size=window_size,
+                  use_mmap=use_mmap, jobs=jobs, map_dir=map_dir,
+                  block_cache=block_cache, digest=digest,
+                  exclude_by=exclude_by, hash_jobs=hash_jobs,
+                  pipeline=pipeline, single_read=single_read,
+                  write_jobs=write_jobs, read_ahead=read_ahead,
+                  resume=resume)
+
+    if len(images) == 1 and not manifest:
+        try:
+            _run(images[0], destination=destination, **kwargs)
+        finally:
+            if stats_json:
+                STATS.write_json(stats_json)
+        return
+
+    _run_batch(images, destination, batch_jobs, dedupe_images, stats_json,
+               kwargs)
+
+
+def _run_batch(images, destination, batch_jobs, dedupe_images, stats_json,
+               kwargs):
+    """Recover several disks with the options given to cli().
+
+    The processes, threads and block cache given are divided between the
+    disks recovered at once.
+
+    Raises:
+        click.ClickException: The recovery of a disk failed.
+    """
+
+    log = logging.getLogger(__name__)
+    batch_jobs = min(batch_jobs, len(images))
+
+    for name in ('jobs', 'hash_jobs', 'write_jobs'):
+        kwargs[name] = max(kwargs[name] / batch_jobs, 1)
+
+    kwargs['block_cache'] /= batch_jobs
+
+    if not os.path.isdir(destination):
+        os.makedirs(destination)
+
+    destinations = image_destinations(images, destination)
+    results = run_batch(images, destinations, _run, kwargs, batch_jobs)
+
+    if dedupe_images:
+        removed = dedupe_outputs(destinations, kwargs['digest'])
+        log.info('Removed %s files recovered from an earlier disk', removed)
+
+    failed = [(image, error) for image, error, _ in results if error]
+
+    for image, error in failed:
+        log.error('Unable to recover %s: %s', image, error)
+
+    if stats_json:
+        report = STATS.report()
+        report['images'] = dict(
+            (image, {'error': error, 'report': image_report})
+            for image, error, image_report in results)
+
+        with open(stats_json, 'w') as file_:
+            json.dump(report, file_, indent=2, sort_keys=True)
+            file_.write('\n')
+
+    if failed:
+        raise click.ClickException('{0} of {1} disks could not be '
+                                   'recovered'.format(len(failed),
+                                                      len(images)))
+
+
+def _run(disk, method, destination, cache, cache_dir, save_cache,
+         space_maps, window_size, use_mmap, jobs, map_dir, block_cache,
+         digest, exclude_by, hash_jobs, pipeline, single_read, write_jobs,
+         read_ahead, resume):
+    """Run the recovery methods with the options given to cli().
+
+    The time taken by each step is recorded in the Stats of the run. The
+    Zfinds is closed afterwards so that another can be created.
+    """
+
+    zfilewriter = ZFileWriter(destination, write_jobs, read_ahead)
+    zfinds = Zfinds(disk, zfilewriter, block_cache, digest, hash_jobs,
+                    pipeline, single_read, read_ahead, exclude_by)
+
+    try:
+        if cache:
+            with STATS.timer('build_cache'):
+                zfinds.build_cache(map_dir,
+                                   cache_dir if save_cache else None)
 
-    if cache:
-        zfinds.build_cache()
+        if method == 'uber' or method == 'all':
+            with STATS.timer('find_uber'):
+                zfinds.find_uber(jobs)
+            with STATS.timer('write_uber'):
+                zfinds.write_uber()
 
-    if method == 'uber' or method == 'all':
-        zfinds.find_uber()
-        zfinds.write_uber()
+        if space_maps and (method == 'brute' or method == 'all'):
+            with STATS.timer('build_free_map'):
+                zfinds.build_free_map(map_dir)
 
-    if method == 'brute' or method == 'all':
-        zfinds.find_brute()
-        zfinds.write_brute()
+        if method == 'brute' or method == 'all':
+            with STATS.timer('find_brute'):
+                zfinds.find_brute(window_size, use_mmap, jobs, resume)
+            with STATS.timer('write_brute'):
+                zfinds.write_brute()
+    finally:
+        zfinds.close()
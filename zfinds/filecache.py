@@ -0,0 +1,170 @@
+import glob
+import logging
+import os
+import pickle
+import tempfile
+
+from .utils import get_dev_size, load_file
+from .zfileinfo import ZFileInfo
+
+CACHE_VERSION = 3
+
+
+class CachedZFileInfo(ZFileInfo):
+    """ZFileInfo of a file loaded from a FileCache.
+
+    The ZFile object is only loaded from the pool when it is first needed,
+    which is when the file has to be read to compare it to another file.
+    """
+
+    def __init__(self, pool, size, partial, digest, name, obj_id, key):
+        """Initialize CachedZFileInfo.
+
+        Args:
+            pool: The loaded pool the file belongs to.
+            size: The size of the ZFile in bytes.
+            partial: The partial digest of the ZFile, if known.
+            digest: The digest of the ZFile, if known.
+            name: The name associated with the ZFile object.
+            obj_id: The object id of the ZFile within its file system.
+            key: The identity of the ZFile, if known.
+        """
+
+        super(CachedZFileInfo, self).__init__(None, name, obj_id)
+        self.pool = pool
+        self.partial = partial
+        self.digest = digest
+        self.key = key
+        self.cached_size = size
+
+    @property
+    def zfile(self):
+        """The ZFile object, loaded from the pool on first use."""
+
+        if self._zfile is None:
+            self._zfile = load_file(self.pool, self.obj_id).zfile
+
+        return self._zfile
+
+    @zfile.setter
+    def zfile(self, zfile):
+        self._zfile = zfile
+
+    def size(self):
+        """Retrieve the size of the ZFile.
+
+        Returns:
+            The size of the ZFile in bytes.
+        """
+
+        return self.cached_size
+
+
+class FileCache(object):
+    """Stores the files and used sectors of a pool on disk.
+
+    Building the cache of current files requires walking the whole current
+    file system. The FileCache saves the result of that walk, the files that
+    were found and the sectors that were read, so that later runs against
+    the same pool can skip the walk.
+
+    A cache is identified by the pool GUID, the txg of the active uberblock
+    and the size of the device. When the pool changes the txg of the active
+    uberblock changes with it, and the old cache is no longer used.
+    """
+
+    def __init__(self, cache_dir, pool_guid, txg, disk):
+        """Initialize FileCache.
+
+        Args:
+            cache_dir: The directory to store caches in.
+            pool_guid: The GUID of the pool.
+            txg: The txg of the active uberblock of the pool.
+            disk: The path to the disk of the pool.
+        """
+
+        self.cache_dir = cache_dir
+        self.key = (pool_guid, txg, get_dev_size(disk))
+        self.path = os.path.join(cache_dir, '{0}-{1}-{2}.cache'.format(
+            *self.key))
+        self.log = logging.getLogger(__name__)
+
+    def load(self, pool, filehash, sector_map):
+        """Load the cache into a ZFileHash and SectorMap.
+
+        Args:
+            pool: The loaded pool the cache was built from.
+            filehash: The ZFileHash to add the cached files to.
+            sector_map: The SectorMap to load the used sectors into.
+
+        Returns:
+            True if a matching cache was loaded, False otherwise.
+        """
+
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'rb') as file_:
+                header = pickle.load(file_)
+
+                if (header['version'] != CACHE_VERSION or
+                        header['key'] != self.key or
+                        header['sectors'] != sector_map.size()):
+                    self.log.info('Ignoring stale file cache %s', self.path)
+                    return False
+
+                sector_map.read_from(file_)
+        except Exception:
+            self.log.warn('Unable to load file cache %s', self.path)
+            return False
+
+        filehash.extend(CachedZFileInfo(pool, *cached)
+                        for cached in header['files'])
+
+        self.log.info('Loaded file cache %s', self.path)
+        return True
+
+    def save(self, filehash, sector_map):
+        """Save a ZFileHash and SectorMap to the cache.
+
+        The cache is written to a temporary file that is renamed into place
+        so that an interrupted save does not leave a partial cache. Caches of
+        other txgs of the same pool are removed.
+
+        Args:
+            filehash: The ZFileHash of current files.
+            sector_map: The SectorMap of used sectors.
+        """
+
+        header = {
+            'version': CACHE_VERSION,
+            'key': self.key,
+            'sectors': sector_map.size(),
+            'files': [(zfile.size(), zfile.partial, zfile.digest, zfile.name,
+                       zfile.obj_id, zfile.key)
+                      for zfile in filehash.zfiles()],
+            }
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+
+        try:
+            with os.fdopen(fd, 'wb') as file_:
+                pickle.dump(header, file_, pickle.HIGHEST_PROTOCOL)
+                sector_map.write_to(file_)
+
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        stale = os.path.join(self.cache_dir, '{0}-*.cache'.format(self.key[0]))
+
+        for path in glob.glob(stale):
+            if path != self.path:
+                os.unlink(path)
+
+        self.log.info('Saved file cache %s', self.path)
@@ -1,3 +1,4 @@
+import struct
 import zfspy
 
 from zfspy import StreamUnpacker
@@ -6,10 +7,20 @@ from zfspy.dmu import OBJSet
 from zfspy.dsl import DSL_Dir
 from zfspy.nvpair import DATA_TYPE, NVPair
 from zfspy.spa import UBERBLOCK_SIZE, BlockPtr, UberBlock
-from zfspy.util import debug, get_record, split_records
+from zfspy.util import debug, get_record
 from zfspy.zap import ZAP, ZBT_MICRO
 from zfspy.zio import ZIO
 
+# The fields at the start of an UberBlock: magic, version, txg, guid_sum and
+# timestamp.
+UBERBLOCK_HEADER = struct.Struct('<5Q')
+UBERBLOCK_MAGIC = 0x00bab10c
+
+# The UberBlocks of each vdev path, found once per process until they are
+# cleared by clear_txg_index(). Maps a path to a dictionary of the txg of
+# each valid UberBlock to its (label, index).
+_txg_index = {}
+
 
 def monkeypatch_method(cls, clsmethod=False):
     """
@@ -71,20 +82,21 @@ def _single_pair_decode(self):
 # Monkeypatch VDevLabel
 #
 
-# Modify the ununsed variable self.uberblocks to be a list. All of the
-# UberBlocks that are found when parsing the VDevLabel will be added to the
-# array for retrieval later.
+# Replace the ununsed variable self.uberblocks with self.ub_index, a
+# dictionary of the txg of each valid UberBlock in the label to its index in
+# the UberBlock array.
 @monkeypatch_method(zfspy.spa.VDevLabel)
 def __init__(self, data=None):
     self.boot_header = None
     self.nvlist = {}
-    self.uberblocks = []
+    self.ub_index = {}
     self.data = ''
     self.ub_array = None
     if data:
         self._from_data(data)
 
-# Add method call to append the found UberBlock to the self.uberblocks array.
+# Index the valid UberBlocks by txg, unpacking only the start of each
+# UberBlock. An UberBlock object is only created for the active UberBlock.
 @monkeypatch_method(zfspy.spa.VDevLabel)
 def _from_data(self, data):
     self.boot_header = data[8 << 10: 16 << 10]
@@ -93,22 +105,29 @@ def _from_data(self, data):
 
     # find the active uberblock
     self.ub_array = data[128 << 10:]
-    ubbest = None
-    i = 0
-    for data in split_records(self.ub_array, UBERBLOCK_SIZE):
-        ub = UberBlock(data, self)
-        ub.index = i
-        i = i + 1
+    best = None
+    for i in xrange(len(self.ub_array) / UBERBLOCK_SIZE):
+        magic, _, txg, _, timestamp = UBERBLOCK_HEADER.unpack_from(
+            self.ub_array, i * UBERBLOCK_SIZE)
+        if magic != UBERBLOCK_MAGIC:
+            continue
 
-        self.uberblocks.append(ub)
+        self.ub_index.setdefault(txg, i)
 
-        if not ub.valid():
-            continue
-        if ub.better_than(ubbest):
-            ubbest = ub
+        if best is None or (txg, timestamp) > best[0]:
+            best = ((txg, timestamp), i)
 
-    self.ubbest = ubbest
-    self.ubbest.load_rootbp()
+    self.ubbest = None
+    if best is not None:
+        self.ubbest = self.get_uberblock(best[1])
+        self.ubbest.load_rootbp()
+
+# Add method to create the UberBlock at an index of the UberBlock array.
+@monkeypatch_method(zfspy.spa.VDevLabel)
+def get_uberblock(self, index):
+    ub = UberBlock(get_record(self.ub_array, UBERBLOCK_SIZE, index), self)
+    ub.index = index
+    return ub
 
 #
 # Monkeypatch SPA
@@ -126,12 +145,34 @@ def vdev_ubtxg_load(self, vdev, txg):
             self.vdev_ubtxg_load(node, txg)
         return
 
-    for label in self.load_labels(vdev.path):
-        for ub in label.uberblocks:
-            if ub.ub_txg == txg:
-                self.ubbest = ub
-                self.labelbest = label
-                self.ubbest.load_rootbp()
+    found = self.load_txg_index(vdev.path).get(txg)
+    if found is not None:
+        label, index = found
+        self.ubbest = label.get_uberblock(index)
+        self.labelbest = label
+        self.ubbest.load_rootbp()
+
+# Add method to find the label and index of the UberBlock of every valid txg
+# on a vdev. The labels are only read the first time a vdev is loaded.
+@monkeypatch_method(zfspy.spa.SPA)
+def load_txg_index(self, path):
+    """
+    Return a dictionary of each valid txg to the (label, index) of its
+    UberBlock.
+    """
+    if path not in _txg_index:
+        index = {}
+        for label in self.load_labels(path):
+            for txg, i in label.ub_index.items():
+                index.setdefault(txg, (label, i))
+        _txg_index[path] = index
+
+    return _txg_index[path]
+
+# Forget the UberBlocks found on every vdev path, so that they are found
+# again the next time a path is loaded, after it may have been written to.
+def clear_txg_index():
+    _txg_index.clear()
 
 # Save builtin open call
 builtin_open = open
@@ -168,6 +209,19 @@ def load_rootbp(self):
     data = get_record(self.label.ub_array, UBERBLOCK_SIZE, self.index)
     self.ub_rootbp = BlockPtr(data[40: 168])
 
+#
+# Monkeypatch BlockPtr
+#
+
+# Keep the raw block pointer so that the level, type and DVAs of the block
+# can be read from it directly.
+blkptr_init = BlockPtr.__init__
+
+@monkeypatch_method(zfspy.spa.BlockPtr)
+def __init__(self, data, *args, **kwargs):
+    blkptr_init(self, data, *args, **kwargs)
+    self.raw = data
+
 #
 # Monkeypatch ZAP
 #
@@ -0,0 +1,110 @@
+import Queue
+import threading
+
+READ_AHEAD = 4  # Reads made ahead of the one being used
+
+_PUT_TIMEOUT = 0.1  # Seconds between checks for a stopped read-ahead
+
+
+def read_ahead(reads, depth=READ_AHEAD):
+    """A generator that makes reads ahead of their use in a thread.
+
+    The given iterable is iterated by a background thread, which keeps up
+    to depth of its items waiting in a bounded queue. Reading from disk
+    releases the GIL, so the disk is kept busy with the next reads while
+    the items already read are decompressed, parsed or hashed.
+
+    Items are yielded in the order of the iterable. An error raised by the
+    iterable is raised once the items before it have been yielded. If the
+    generator is closed early the thread stops, and closes the iterable if
+    it is a generator, before the generator returns.
+
+    Args:
+        reads: An iterable whose items are read from disk.
+        depth: The number of items that may be read ahead. If 0 the
+            iterable is used directly, without a thread.
+
+    Yields:
+        The items of the iterable.
+    """
+
+    if depth <= 0:
+        for item in reads:
+            yield item
+        return
+
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    thread = threading.Thread(target=_read, args=(reads, queue, stop))
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            done, item = queue.get()
+
+            if done:
+                if item is not None:
+                    raise item
+                return
+
+            yield item
+    finally:
+        stop.set()
+
+        # Empty the queue so that a blocked thread sees it was stopped.
+        while thread.is_alive():
+            try:
+                queue.get(timeout=_PUT_TIMEOUT)
+            except Queue.Empty:
+                pass
+
+        thread.join()
+
+
+def _read(reads, queue, stop):
+    """Iterate reads ahead of their use until stopped.
+
+    Runs in the read-ahead thread. Each item is queued as (False, item).
+    Once the iterable ends, or raises an error, (True, error) is queued with
+    an error of None when the iterable ended.
+
+    Args:
+        reads: The iterable to read the items of.
+        queue: The bounded queue to put the items in.
+        stop: Event set once the items are no longer wanted.
+    """
+
+    try:
+        for item in reads:
+            if not _put(queue, stop, (False, item)):
+                return
+
+        _put(queue, stop, (True, None))
+    except Exception as error:
+        _put(queue, stop, (True, error))
+    finally:
+        if hasattr(reads, 'close'):
+            reads.close()
+
+
+def _put(queue, stop, entry):
+    """Put an entry in the queue unless the read-ahead is stopped.
+
+    Args:
+        queue: The queue to put the entry in.
+        stop: Event set once the items are no longer wanted.
+        entry: The entry to put in the queue.
+
+    Returns:
+        True if the entry was queued, False if the read-ahead was stopped.
+    """
+
+    while not stop.is_set():
+        try:
+            queue.put(entry, timeout=_PUT_TIMEOUT)
+            return True
+        except Queue.Full:
+            pass
+
+    return False
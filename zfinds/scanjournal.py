@@ -0,0 +1,173 @@
+import logging
+import os
+import pickle
+import time
+
+JOURNAL_VERSION = 2
+JOURNAL_INTERVAL = 60  # Seconds between journal writes
+
+
+class ScanJournal(object):
+    """Journal of the progress of a brute scan.
+
+    A ScanJournal records how far a scan for dnodes has progressed and the
+    raw dnodes found so far, so that an interrupted scan can be resumed
+    instead of being started again from the first sector.
+
+    The journal is a file of pickled entries. After a header identifying the
+    pool, each entry records the sector below which the scan is complete and
+    the dnodes found since the previous entry. Entries are only appended and
+    are synced to disk once written, so an interrupted write can at worst
+    leave a partial last entry, which is discarded when the journal is
+    loaded.
+    """
+
+    def __init__(self, path, key, interval=JOURNAL_INTERVAL):
+        """Initialize ScanJournal.
+
+        Args:
+            path: The path of the journal file.
+            key: A tuple identifying the pool and scan the journal is for.
+            interval: The minimum number of seconds between journal writes.
+        """
+
+        self.path = path
+        self.key = key
+        self.interval = interval
+        self.sector = 0
+        self.found = 0
+        self.entries = (0, 0)
+        self.pending = []
+        self.file_ = None
+        self.last_write = 0
+        self.log = logging.getLogger(__name__)
+
+    def create(self):
+        """Start a new, empty journal, replacing any existing journal."""
+
+        self.sector = 0
+        self.found = 0
+        self.entries = (0, 0)
+        self.pending = []
+        self.file_ = open(self.path, 'wb')
+        pickle.dump({'version': JOURNAL_VERSION, 'key': self.key},
+                    self.file_, pickle.HIGHEST_PROTOCOL)
+        self._sync()
+
+    def load(self):
+        """Load an existing journal so that it can be continued.
+
+        Returns:
+            True if a journal of the same pool and scan was loaded, False
+            otherwise.
+        """
+
+        if not os.path.exists(self.path):
+            return False
+
+        file_ = open(self.path, 'r+b')
+
+        try:
+            header = pickle.load(file_)
+        except Exception:
+            header = None
+
+        if (not isinstance(header, dict) or
+                header.get('version') != JOURNAL_VERSION or
+                header.get('key') != self.key):
+            self.log.warn('Ignoring journal %s of another scan', self.path)
+            file_.close()
+            return False
+
+        first = good = file_.tell()
+
+        while True:
+            try:
+                sector, records = pickle.load(file_)
+            except Exception:
+                break
+
+            self.sector = sector
+            self.found += len(records)
+            good = file_.tell()
+
+        # Drop a partially written last entry before appending to the file.
+        file_.seek(good)
+        file_.truncate()
+        self.file_ = file_
+        self.entries = (first, good)
+
+        self.log.info('Resuming scan from sector %s with %s dnodes',
+                      self.sector, self.found)
+        return True
+
+    def replay(self):
+        """A generator that yields the dnodes recorded in a loaded journal.
+
+        The entries are read from the journal file as they are yielded so
+        that the recorded dnodes are not all held in memory.
+
+        Yields:
+            Lists of the raw dnodes recorded in each entry, in the order they
+            were found.
+        """
+
+        first, end = self.entries
+
+        if first == end:
+            return
+
+        with open(self.path, 'rb') as file_:
+            file_.seek(first)
+
+            while file_.tell() < end:
+                _, records = pickle.load(file_)
+                yield records
+
+    def checkpoint(self, sector, records):
+        """Record the progress of the scan.
+
+        The journal is written if the interval has passed since it was last
+        written.
+
+        Args:
+            sector: The sector below which the scan is complete.
+            records: The raw dnodes found since the last checkpoint.
+        """
+
+        self.sector = sector
+        self.pending.extend(records)
+
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        """Write the progress recorded since the last write."""
+
+        pickle.dump((self.sector, self.pending), self.file_,
+                    pickle.HIGHEST_PROTOCOL)
+        self.pending = []
+        self._sync()
+
+    def close(self):
+        """Write any recorded progress and close the journal."""
+
+        if self.file_ is not None:
+            self.write()
+            self.file_.close()
+            self.file_ = None
+
+    def remove(self):
+        """Close and delete the journal once it is no longer needed."""
+
+        self.close()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _sync(self):
+        """Flush the journal file to disk."""
+
+        self.file_.flush()
+        os.fsync(self.file_.fileno())
+        self.last_write = time.time()
@@ -1,4 +1,14 @@
-import bitmap
+import ctypes
+import mmap
+import re
+import tempfile
+
+# Patterns matching the first byte that has at least one bit of the given
+# value, allowing whole bytes of the other value to be skipped in C.
+_HAS_UNSET = re.compile(b'[^\xff]')
+_HAS_SET = re.compile(b'[^\x00]')
+
+_COPY_CHUNK = 1048576  # Copy mmap backed maps 1M at a time
 
 
 class SectorMap(object):
@@ -7,16 +17,109 @@ class SectorMap(object):
     Used to keep track of use of sectors on a disk. Bits in the bitmap
     represents a sector on disk. Can be used as a boolean flag for disk
     sectors.
+
+    The bitmap is kept in a bytearray, or in a memory mapped temporary file
+    when a map_dir is given, so that maps of large disks do not have to be
+    resident in memory. Runs of set or unset sectors are located by skipping
+    over whole bytes of the other value rather than testing every bit.
     """
 
-    def __init__(self, size):
+    def __init__(self, size, map_dir=None):
         """Initialize SectorMap.
 
         Args:
             size: The number of sectors to account for.
+            map_dir: Directory to create the memory mapped bitmap in. If None
+                the bitmap is kept in memory.
         """
+
         self.map_size = size
-        self.map = bitmap.BitMap(size)
+        self.map_dir = map_dir
+        self.map_bytes = (size + 7) / 8
+
+        if map_dir is None:
+            self.buffer = bytearray(self.map_bytes)
+            self.map = self.buffer
+        else:
+            self.buffer = self._map_file(self.map_bytes, map_dir)
+            self.map = (ctypes.c_ubyte * self.map_bytes).from_buffer(
+                self.buffer)
+
+    @staticmethod
+    def _map_file(size, map_dir):
+        """Create a memory mapped temporary file.
+
+        The file is unlinked as soon as it is created so that it is removed
+        once the map is no longer in use.
+
+        Args:
+            size: The size of the file in bytes.
+            map_dir: The directory to create the file in.
+
+        Returns:
+            A writable mmap of the temporary file.
+        """
+
+        file_ = tempfile.TemporaryFile(dir=map_dir)
+
+        try:
+            file_.truncate(max(size, 1))
+            return mmap.mmap(file_.fileno(), max(size, 1))
+        finally:
+            file_.close()
+
+    def copy(self):
+        """Create a copy of the SectorMap.
+
+        The copy is backed the same way as this SectorMap.
+
+        Returns:
+            A new SectorMap with the same sectors set.
+        """
+
+        sector_map = SectorMap(self.map_size, self.map_dir)
+
+        if self.map_dir is None:
+            sector_map.buffer[:] = self.buffer
+        else:
+            for pos in xrange(0, self.map_bytes, _COPY_CHUNK):
+                end = min(pos + _COPY_CHUNK, self.map_bytes)
+                sector_map.buffer[pos:end] = self.buffer[pos:end]
+
+        return sector_map
+
+    def write_to(self, file_):
+        """Write the bitmap of the SectorMap to a file.
+
+        Args:
+            file_: The file object to write to.
+        """
+
+        for pos in xrange(0, self.map_bytes, _COPY_CHUNK):
+            end = min(pos + _COPY_CHUNK, self.map_bytes)
+            file_.write(bytes(self.buffer[pos:end]))
+
+    def read_from(self, file_):
+        """Read the bitmap of the SectorMap from a file.
+
+        The file must have been written by write_to() from a SectorMap of
+        the same size.
+
+        Args:
+            file_: The file object to read from.
+
+        Raises:
+            ValueError: The file ended before the bitmap was read.
+        """
+
+        for pos in xrange(0, self.map_bytes, _COPY_CHUNK):
+            end = min(pos + _COPY_CHUNK, self.map_bytes)
+            data = file_.read(end - pos)
+
+            if len(data) != end - pos:
+                raise ValueError('Sector map is truncated')
+
+            self.buffer[pos:end] = data
 
     def get(self, sector):
         """Retrieve a sectors status.
@@ -28,7 +131,7 @@ class SectorMap(object):
             The value of the sector at the given position.
         """
 
-        return self.get(sector)
+        return bool(self.map[sector >> 3] & (1 << (sector & 7)))
 
     def set(self, sector):
         """Set a sectors status.
@@ -38,7 +141,65 @@ class SectorMap(object):
         Args:
             sector: The sector position to set.
         """
-        self.map.set(sector)
+
+        self.map[sector >> 3] |= 1 << (sector & 7)
+
+    def set_range(self, start, count):
+        """Set the status of a run of sectors.
+
+        Whole bytes of the bitmap within the run are set at once.
+
+        Args:
+            start: The first sector position to set.
+            count: The number of sectors to set.
+        """
+
+        end = min(start + count, self.map_size)
+
+        while start < end and start & 7:
+            self.set(start)
+            start += 1
+
+        while end > start and end & 7:
+            end -= 1
+            self.set(end)
+
+        if start < end:
+            self.buffer[start >> 3:end >> 3] = b'\xff' * ((end - start) >> 3)
+
+    def unset(self, sector):
+        """Clear a sectors status.
+
+        Clears the sector flag at the given sector position.
+
+        Args:
+            sector: The sector position to clear.
+        """
+
+        self.map[sector >> 3] &= ~(1 << (sector & 7)) & 0xff
+
+    def unset_range(self, start, count):
+        """Clear the status of a run of sectors.
+
+        Whole bytes of the bitmap within the run are cleared at once.
+
+        Args:
+            start: The first sector position to clear.
+            count: The number of sectors to clear.
+        """
+
+        end = min(start + count, self.map_size)
+
+        while start < end and start & 7:
+            self.unset(start)
+            start += 1
+
+        while end > start and end & 7:
+            end -= 1
+            self.unset(end)
+
+        if start < end:
+            self.buffer[start >> 3:end >> 3] = b'\0' * ((end - start) >> 3)
 
     def size(self):
         """Retrieve the size of the SectorMap.
@@ -49,28 +210,113 @@ class SectorMap(object):
 
         return self.map_size
 
+    def _find(self, value, sector):
+        """Find the first sector with the given value.
+
+        Args:
+            value: The sector status to look for.
+            sector: The sector position to start looking from.
+
+        Returns:
+            The position of the first sector at or after the given sector
+            with the given value, or None if there is no such sector.
+        """
+
+        # Test bit by bit until the sector is byte aligned.
+        while sector < self.map_size and sector & 7:
+            if self.get(sector) == value:
+                return sector
+            sector += 1
+
+        if sector >= self.map_size:
+            return None
+
+        pattern = _HAS_SET if value else _HAS_UNSET
+        match = pattern.search(self.buffer, sector >> 3, self.map_bytes)
+
+        if match is None:
+            return None
+
+        sector = match.start() << 3
+
+        for ii in xrange(8):
+            if self.get(sector + ii) == value:
+                sector += ii
+                break
+
+        if sector >= self.map_size:
+            return None
+
+        return sector
+
+    def _runs(self, value):
+        """A generator that yields runs of sectors with the given value.
+
+        Args:
+            value: The sector status of the runs.
+
+        Yields:
+            Tuples of (start, length) for each run of sectors.
+        """
+
+        sector = 0
+
+        while sector < self.map_size:
+            start = self._find(value, sector)
+
+            if start is None:
+                return
+
+            end = self._find(not value, start)
+
+            if end is None:
+                end = self.map_size
+
+            yield start, end - start
+            sector = end
+
+    def unset_runs(self):
+        """A generator that yields runs of unset sectors.
+
+        Yields:
+            Tuples of (start, length) for each run of unset sectors.
+        """
+
+        return self._runs(False)
+
+    def set_runs(self):
+        """A generator that yields runs of set sectors.
+
+        Yields:
+            Tuples of (start, length) for each run of set sectors.
+        """
+
+        return self._runs(True)
+
     def unset_gen(self):
         """A generator that yields unset sectors.
 
-        Loops over all of the sectors in the map and yields the unset ones.
+        Loops over the runs of unset sectors in the map and yields the
+        sectors within them.
 
         Yields:
             Unset sectors in the map.
         """
 
-        for sector in xrange(self.map_size):
-            if not self.map.test(sector):
+        for start, length in self.unset_runs():
+            for sector in xrange(start, start + length):
                 yield sector
 
     def set_gen(self):
         """A generator that yields set sectors.
 
-        Loops over all of the sectors in the map and yields the set ones.
+        Loops over the runs of set sectors in the map and yields the
+        sectors within them.
 
         Yields:
             Set sectors in the map.
         """
 
-        for sector in xrange(self.map_size):
-            if self.map.test(sector):
+        for start, length in self.set_runs():
+            for sector in xrange(start, start + length):
                 yield sector
@@ -1,5 +1,4 @@
-import copy
-import math
+import threading
 
 from functools import wraps
 
@@ -19,29 +18,43 @@ class SectorTracker(object):
     sectors on a ZFS disk during a data walk. These sectors could then be
     skipped during a scan of the disk for inactive dnodes. This is utilized to
     speed up the brute force method of finding dnodes.
+
+    Reads are recorded as extents of sectors. Reads that overlap or follow on
+    from the previous read are merged into its extent, and an extent is only
+    written to the SectorMap once a read outside of it is made. The SectorMap
+    handed out by get_map() is shared with the tracker rather than copied,
+    and is only copied if the tracker has to mark further sectors.
+
+    Attributes:
+        track: If False, reads are passed through without being tracked.
     """
 
-    def __init__(self, func, dev):
+    def __init__(self, func, dev, map_dir=None):
         """Initialize SectorTracker.
 
         Args:
             func: The function that is being decorated.
             dev: The device to track.
+            map_dir: Directory to memory map the SectorMap in. If None the
+                SectorMap is kept in memory.
         """
         self.dev = dev
         self.dev_size = get_dev_size(dev)
         self.dev_sectors = self.dev_size / SECTOR_SIZE
         self.func = func
-        self.sector_map = SectorMap(self.dev_sectors)
-        self.track = False
+        self.sector_map = SectorMap(self.dev_sectors, map_dir)
+        self.extent = None
+        self.shared = False
+        self.track = True
+        self.lock = threading.Lock()
         wraps(func)(self)
 
     def __call__(self, dev, offset, size, *args, **kwargs):
         """Calculate the sector(s) and call the decorated function.
 
         When the object is called, the sectors that are being access is
-        calculated and the SectorMap is updated accordingly. Once the SectorMap
-        is updated the decorated function is called.
+        calculated and recorded for the SectorMap. Once the sectors are
+        recorded the decorated function is called.
 
         Args:
             dev: The device to read from.
@@ -52,6 +65,9 @@ class SectorTracker(object):
             The data read by the decorated function.
         """
 
+        if not self.track:
+            return self.func(dev, offset, size, *args, **kwargs)
+
         # If offset if negative then the reference point on the disk is the
         # end, not the beginning like with a positive offset. Make sure
         # reference point is the beginning of the disk.
@@ -60,31 +76,79 @@ class SectorTracker(object):
         else:
             true_offset = offset
 
-        sector = true_offset / SECTOR_SIZE
-        count = int(math.ceil(size / SECTOR_SIZE))
-
-        sectors = []
-        for ii in xrange(0, count):
-            sectors.append(sector+ii)
-            self.sector_map.set(sector + ii)
+        start = true_offset / SECTOR_SIZE
+        end = (true_offset + size + SECTOR_SIZE - 1) / SECTOR_SIZE
+        self._record(start, end)
 
         return self.func(dev, offset, size, *args, **kwargs)
 
+    def mark(self, sector, count):
+        """Record sectors as used without reading them.
+
+        Args:
+            sector: The first sector to record.
+            count: The number of sectors to record.
+        """
+
+        self._record(sector, sector + count)
+
+    def _record(self, start, end):
+        """Merge sectors into the current extent.
+
+        Args:
+            start: The first sector.
+            end: The sector after the last sector.
+        """
+
+        with self.lock:
+            if (self.extent is not None and start <= self.extent[1] and
+                    end >= self.extent[0]):
+                self.extent = (min(start, self.extent[0]),
+                               max(end, self.extent[1]))
+            else:
+                self._flush()
+                self.extent = (start, end)
+
+    def _flush(self):
+        """Write the current extent to the SectorMap.
+
+        If the SectorMap has been handed out by get_map() it is copied first,
+        so that the handed out SectorMap does not change.
+        """
+
+        if self.extent is None:
+            return
+
+        if self.shared:
+            self.sector_map = self.sector_map.copy()
+            self.shared = False
+
+        start, end = self.extent
+        self.sector_map.set_range(start, end - start)
+        self.extent = None
+
+    def flush(self):
+        """Write all recorded sectors to the SectorMap."""
+
+        with self.lock:
+            self._flush()
+
     def get_map(self):
         """Retrieve the SectorMap.
 
-        Creates a copy of the SectorMap and returns it. Since the sector_map is
-        an Object it is possible that if not copied, it could be modified
-        outside of the SectorTracker object, which would affect the sector_map
-        object that is currently in use. Therefore a deep copy of the SectorMap
-        object is made before returning.
+        The SectorMap is returned without being copied. It must not be
+        modified by the caller. If the tracker marks further sectors it
+        copies the SectorMap first, so the returned SectorMap does not change.
 
         Returns:
             A SectorMap object representing the sectors that have been
                 accessed.
         """
 
-        return copy.deepcopy(self.sector_map)
+        with self.lock:
+            self._flush()
+            self.shared = True
+            return self.sector_map
 
     def reset(self):
         """Reset the SectorMap.
@@ -92,4 +156,8 @@ class SectorTracker(object):
         Creates a new SectorMap for tracking used sectors.
         """
 
-        self.sector_map = SectorMap(self.sector_map.size())
+        with self.lock:
+            self.sector_map = SectorMap(self.sector_map.size(),
+                                        self.sector_map.map_dir)
+            self.extent = None
+            self.shared = False
@@ -0,0 +1,221 @@
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+
+PROGRESS_INTERVAL = 10  # Seconds between progress lines
+
+# Counters whose rate is measured over the time of a phase rather than the
+# whole run.
+RATE_TIMERS = {
+    'sectors_scanned': 'scan',
+    'scan_bytes_read': 'scan',
+    'lzjb_attempts': 'scan',
+    'dnodes_parsed': 'scan',
+    'txgs_walked': 'find_uber',
+    }
+
+
+class Stats(object):
+    """Counters and timers of the work done during recovery.
+
+    Stats are shared by every part of a run through the STATS instance of
+    this module and may be updated from any thread. Worker processes start
+    with their own empty Stats, and send the counters they collect back to
+    the parent process with their results to be merged.
+
+    When progress is enabled, the progress of long running phases is written
+    to stderr at intervals along with an estimate of the time remaining.
+    Progress lines start with the label, if one is set, so that the lines of
+    several runs writing to the same stderr can be told apart.
+    """
+
+    def __init__(self):
+        """Initialize Stats."""
+
+        self.counters = collections.Counter()
+        self.timers = collections.Counter()
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.show_progress = False
+        self.label = None
+        self.interval = PROGRESS_INTERVAL
+        self.phase = None
+        self.total = 0
+        self.unit = None
+        self.phase_start = 0
+        self.last_progress = 0
+
+    def add(self, name, value=1):
+        """Add to a counter.
+
+        Args:
+            name: The name of the counter.
+            value: The amount to add to the counter.
+        """
+
+        with self.lock:
+            self.counters[name] += value
+
+    def merge(self, counters):
+        """Add the counters collected by a worker process.
+
+        Args:
+            counters: A dictionary of counter names and values.
+        """
+
+        with self.lock:
+            self.counters.update(counters)
+
+    def take(self):
+        """Retrieve the counters and start them again from zero.
+
+        Used by worker processes to send the counters collected since they
+        were last taken to the parent process.
+
+        Returns:
+            A dictionary of counter names and values.
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+            self.counters.clear()
+
+        return counters
+
+    def reset(self):
+        """Clear all counters and timers."""
+
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+            self.started = time.time()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Context manager that adds the time spent within it to a timer.
+
+        Args:
+            name: The name of the timer.
+        """
+
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+
+            with self.lock:
+                self.timers[name] += elapsed
+
+    def start_progress(self, phase, total, unit):
+        """Start reporting the progress of a phase.
+
+        Args:
+            phase: The name of the phase.
+            total: The amount of work in the phase.
+            unit: The name of the units of work.
+        """
+
+        self.phase = phase
+        self.total = total
+        self.unit = unit
+        self.phase_start = time.time()
+        self.last_progress = self.phase_start
+
+    def progress(self, done):
+        """Report the progress of the current phase.
+
+        A progress line is only written once the interval has passed since
+        the last one.
+
+        Args:
+            done: The amount of work done so far in the phase.
+        """
+
+        now = time.time()
+
+        if not self.show_progress or now - self.last_progress < self.interval:
+            return
+
+        self.last_progress = now
+        elapsed = now - self.phase_start
+        rate = done / elapsed if elapsed > 0 else 0.0
+        percent = 100.0 * done / self.total if self.total else 100.0
+
+        if rate > 0:
+            eta = _format_seconds((self.total - done) / rate)
+        else:
+            eta = 'unknown'
+
+        phase = self.phase
+
+        if self.label:
+            phase = '{0}: {1}'.format(self.label, phase)
+
+        sys.stderr.write(
+            '{0}: {1:.1f}% ({2}/{3} {4}) {5:.1f} {4}/s ETA {6}\n'.format(
+                phase, percent, done, self.total, self.unit, rate, eta))
+        sys.stderr.flush()
+
+    def report(self):
+        """Create a report of the counters and timers.
+
+        Rates are given per second of the phase the counter belongs to, or
+        of the whole run for counters that are updated in several phases.
+
+        Returns:
+            A dictionary of the elapsed time, counters, timers and rates.
+        """
+
+        with self.lock:
+            counters = dict(self.counters)
+            timers = dict(self.timers)
+
+        elapsed = time.time() - self.started
+        rates = {}
+
+        for name, value in counters.items():
+            seconds = timers.get(RATE_TIMERS.get(name), elapsed)
+
+            if seconds > 0:
+                rates[name] = value / seconds
+
+        return {
+            'elapsed': elapsed,
+            'counters': counters,
+            'timers': timers,
+            'rates': rates,
+            }
+
+    def write_json(self, path):
+        """Write the report of the counters and timers to a JSON file.
+
+        Args:
+            path: The path of the file to write.
+        """
+
+        with open(path, 'w') as file_:
+            json.dump(self.report(), file_, indent=2, sort_keys=True)
+            file_.write('\n')
+
+
+def _format_seconds(seconds):
+    """Format a number of seconds as hours, minutes and seconds.
+
+    Args:
+        seconds: The number of seconds.
+
+    Returns:
+        A string of the form H:MM:SS.
+    """
+
+    seconds = int(seconds)
+    return '{0}:{1:02}:{2:02}'.format(seconds / 3600, seconds / 60 % 60,
+                                      seconds % 60)
+
+
+STATS = Stats()
@@ -1,14 +1,71 @@
+import collections
+import mmap
+import multiprocessing
 import os
+import re
+import struct
 import zfspy
 
+from .readahead import READ_AHEAD, read_ahead
+from .sectormap import SectorMap
+from .stats import STATS
+from .zfilehash import ZFileHash
 from .zfileinfo import ZFileInfo
 
 SECTOR_SIZE = 512
+SECTOR_SHIFT = 9
 DNODE_SIZE = 512
 
+SCAN_READ_SIZE = 1024  # Bytes handed to lzjb for each scanned sector
+SCAN_WINDOW = 8388608  # 8M read from disk at a time while scanning
+SCAN_SHARD = 268435456  # 256M of disk scanned by each worker task
+SCAN_QUEUE = 2  # Shards scanned ahead of the results used per worker
+WALK_BATCH = 1024  # Directory entries opened at a time while walking
+
+# Ranges of the fields of a dnode that is in use.
+DNODE_MIN_INDBLKSHIFT = 10
+DNODE_MAX_INDBLKSHIFT = 17
+DNODE_MAX_LEVELS = 19
+DNODE_MAX_BLKPTR = 3
+DNODE_CORE_SIZE = 64
+BLKPTR_SIZE = 128
+
+# Fields of the properties of a block pointer, which follow its three DVAs.
+BLKPTR_PROP = struct.Struct('<Q')
+BLKPTR_PROP_OFFSET = 48
+BP_TYPE_SHIFT = 48
+BP_TYPE_MASK = 0xff
+BP_LEVEL_SHIFT = 56
+BP_LEVEL_MASK = 0x1f
+OT_PLAIN_FILE_CONTENTS = 19  # DMU object type of the data blocks of files
+
+# The txg a block pointer was born in, which is 0 for a hole.
+BLKPTR_BIRTH = struct.Struct('<Q')
+BLKPTR_BIRTH_OFFSET = 80
+
+# The DVAs of a block pointer: the allocated sectors in the first word and
+# the offset in sectors from the start of the vdev data in the second.
+DVA = struct.Struct('<2Q')
+DVA_ASIZE_MASK = (1 << 24) - 1
+DVA_OFFSET_MASK = (1 << 63) - 1
+
+# Pattern matching the first non zero byte of scanned data.
+_NONZERO = re.compile(b'[^\x00]')
+
 LABEL_OFFSET = 0
 VDEV_OFFSET = LABEL_OFFSET + 16384  # 16k offset from beginning of the label
 VDEV_SIZE = 114688  # 112K of NVPairs
+VDEV_DATA_OFFSET = 4194304  # DVA offsets start after two labels and boot
+
+# Fields of a space map entry, and of the space_map_obj bonus of a space
+# map object: the object, the bytes of entries and the bytes allocated.
+SM_DEBUG_SHIFT = 63
+SM_OFFSET_SHIFT = 16
+SM_OFFSET_MASK = (1 << 47) - 1
+SM_TYPE_SHIFT = 15
+SM_RUN_MASK = (1 << 15) - 1
+SM_FREE = 1
+_SPACE_MAP_OBJ = struct.Struct('<3Q')
 
 
 def get_dev_size(dev):
@@ -33,6 +90,106 @@ def get_dev_size(dev):
         os.close(file_)
 
 
+def get_blkptr_key(data):
+    """Return a key identifying the block a block pointer points to.
+
+    The key is made from the DVAs and birth txg of the block pointer. Since
+    ZFS never overwrites a block in place, two block pointers with the same
+    key point to the same block contents.
+
+    Args:
+        data: The raw block pointer, see the raw attribute that monkeypatch
+            adds to zfspy.BlockPtr.
+
+    Returns:
+        A hashable string identifying the block, or None for a hole.
+    """
+
+    birth = data[BLKPTR_BIRTH_OFFSET:BLKPTR_BIRTH_OFFSET + BLKPTR_BIRTH.size]
+
+    if not BLKPTR_BIRTH.unpack(birth)[0]:
+        return None
+
+    return data[:BLKPTR_PROP_OFFSET] + birth
+
+
+def get_blkptr_props(data):
+    """Parse the level and type of the block a block pointer points to.
+
+    Args:
+        data: The raw block pointer, see the raw attribute that monkeypatch
+            adds to zfspy.BlockPtr.
+
+    Returns:
+        A tuple of (level, type) of the block, where type is the number of
+        its DMU object type.
+    """
+
+    prop, = BLKPTR_PROP.unpack_from(data, BLKPTR_PROP_OFFSET)
+
+    level = prop >> BP_LEVEL_SHIFT & BP_LEVEL_MASK
+    kind = prop >> BP_TYPE_SHIFT & BP_TYPE_MASK
+
+    return level, kind
+
+
+def get_blkptr_extents(data):
+    """Find the sectors of the copies of the block a block pointer points to.
+
+    Args:
+        data: The raw block pointer, see the raw attribute that monkeypatch
+            adds to zfspy.BlockPtr.
+
+    Returns:
+        A list of (sector, count) tuples of the first sector on the device
+        and the number of sectors of each copy. The list is empty for a
+        hole.
+    """
+
+    extents = []
+
+    for pos in xrange(0, BLKPTR_PROP_OFFSET, DVA.size):
+        word0, word1 = DVA.unpack_from(data, pos)
+        count = word0 & DVA_ASIZE_MASK
+
+        if count:
+            extents.append((VDEV_DATA_OFFSET / SECTOR_SIZE +
+                            (word1 & DVA_OFFSET_MASK), count))
+
+    return extents
+
+
+def mark_blocks(vdev_tree, dnode, mark):
+    """Mark the sectors of the blocks of an object without reading its data.
+
+    The sectors of every block of the object are found from the block
+    pointers in its dnode and in its indirect blocks, so only the indirect
+    blocks are read.
+
+    Args:
+        vdev_tree: The VDev information for the ZFS pool.
+        dnode: The zfspy.DNode of the object.
+        mark: Function called with the first sector and the number of
+            sectors of each copy of each block.
+    """
+
+    stack = [blkptr.raw for blkptr in dnode.blkptr]
+
+    while stack:
+        data = stack.pop()
+        extents = get_blkptr_extents(data)
+
+        for sector, count in extents:
+            mark(sector, count)
+
+        level, _ = get_blkptr_props(data)
+
+        if level and extents:
+            block = zfspy.ZIO.read_blk(vdev_tree, zfspy.spa.BlockPtr(data))
+            stack.extend(block[pos:pos + BLKPTR_SIZE]
+                         for pos in xrange(0, len(block), BLKPTR_SIZE))
+
+
 def get_file_from_dnode(dnode):
     """Parse a ZFile from a given dnode.
 
@@ -61,28 +218,23 @@ def get_uberblocks(disk, vdev_tree):
     will locate the valid UberBlocks and return them in a dictionary indexed by
     their ub_txg (transaction group number).
 
+    The labels of the disk are read once per process and the UberBlock
+    arrays are indexed without creating UberBlock objects. Loading a txg
+    from the pool uses the same index, and only creates the UberBlock of
+    that txg.
+
     Args:
         disk: The disk to load the UberBlocks from.
         vdev_tree: The VDev information for the ZFS pool.
 
     Returns:
-        A dictionary of UberBlock objects indexed by their ub_txg value.
+        A dictionary of the (label, index) of each UberBlock in the UberBlock
+        arrays of the labels, indexed by their ub_txg value.
     """
 
     spa = zfspy.SPA(vdev_tree)
-    labels = spa.load_labels(disk)
-    valid = {}
-
-    for label in labels:
-        for uberb in label.uberblocks:
-            if not uberb.valid():
-                continue
 
-            if uberb.ub_txg in valid:
-                continue
-            valid[uberb.ub_txg] = uberb
-
-    return valid
+    return dict(spa.load_txg_index(disk))
 
 
 def get_vdev_info(disk):
@@ -107,95 +259,891 @@ def get_vdev_info(disk):
     return vdev_info
 
 
-def walk_files(pool, filehash):
+def get_free_map(pool, disk, map_dir=None):
+    """Create a SectorMap of the sectors allocated in a pool.
+
+    The sectors are found from the metaslab space maps of the loaded txg of
+    the pool, which record every extent allocated and freed in each
+    metaslab. Every sector is set in the map except the sectors of the
+    metaslabs that are free, so that only free space is scanned. Unlike a
+    walk of the file system, this marks all allocated metadata, such as
+    other datasets, intent logs and the space maps themselves, while only
+    reading the space maps.
+
+    Args:
+        pool: The loaded pool to read the space maps of.
+        disk: The disk of the pool.
+        map_dir: Directory to memory map the SectorMap in. If None the
+            SectorMap is kept in memory.
+
+    Returns:
+        A SectorMap with the allocated sectors set, or None if the pool has
+        no space maps.
+    """
+
+    vdev_tree = pool.spa.labelbest.data.vdev_tree
+
+    if 'metaslab_array' not in vdev_tree or not vdev_tree.metaslab_array:
+        return None
+
+    data = zfspy.ZIO.read_blk(vdev_tree, pool.spa.ubbest.ub_rootbp)
+    metadnode = zfspy.DNode(vdev_tree, data[:DNODE_SIZE])
+
+    ms_shift = vdev_tree.metaslab_shift
+    ms_count = vdev_tree.asize >> ms_shift
+    ms_array = _read_object(
+        _get_object(vdev_tree, metadnode, vdev_tree.metaslab_array),
+        ms_count * 8)
+    sm_shift = vdev_tree.ashift - SECTOR_SHIFT
+
+    sector_map = SectorMap(get_dev_size(disk) / SECTOR_SIZE, map_dir)
+    sector_map.set_range(0, sector_map.size())
+
+    for ms_id, sm_obj in enumerate(struct.unpack('<{0}Q'.format(ms_count),
+                                                 ms_array)):
+        start = (VDEV_DATA_OFFSET + (ms_id << ms_shift)) / SECTOR_SIZE
+        sector_map.unset_range(start, (1 << ms_shift) / SECTOR_SIZE)
+
+        if not sm_obj:
+            continue
+
+        dnode = _get_object(vdev_tree, metadnode, sm_obj)
+        _, size, _ = _SPACE_MAP_OBJ.unpack_from(dnode.bonus)
+        entries = _read_object(dnode, size)
+
+        for entry in struct.unpack('<{0}Q'.format(size / 8), entries):
+            if entry >> SM_DEBUG_SHIFT:
+                continue
+
+            offset = start + ((entry >> SM_OFFSET_SHIFT & SM_OFFSET_MASK) <<
+                              sm_shift)
+            run = ((entry & SM_RUN_MASK) + 1) << sm_shift
+
+            if entry >> SM_TYPE_SHIFT & 1 == SM_FREE:
+                sector_map.unset_range(offset, run)
+            else:
+                sector_map.set_range(offset, run)
+
+        STATS.add('space_map_entries', size / 8)
+
+    return sector_map
+
+
+def _get_object(vdev_tree, metadnode, obj_id):
+    """Parse the dnode of an object from an object set.
+
+    Args:
+        vdev_tree: The VDev information for the ZFS pool.
+        metadnode: The zfspy.DNode of the dnodes of the object set.
+        obj_id: The id of the object.
+
+    Returns:
+        The zfspy.DNode of the object.
+    """
+
+    per_block = metadnode.datablkszsec * SECTOR_SIZE / DNODE_SIZE
+    block = metadnode.get_blk(obj_id / per_block)
+    pos = obj_id % per_block * DNODE_SIZE
+
+    return zfspy.DNode(vdev_tree, block[pos:pos + DNODE_SIZE])
+
+
+def _read_object(dnode, size):
+    """Read the contents of an object.
+
+    Args:
+        dnode: The zfspy.DNode of the object.
+        size: The number of bytes of the object to read.
+
+    Returns:
+        The first size bytes of the object.
+    """
+
+    data = []
+    read = 0
+    blkid = 0
+
+    while read < size and blkid <= dnode.maxblkid:
+        block = dnode.get_blk(blkid)
+        data.append(block)
+        read += len(block)
+        blkid += 1
+
+    return b''.join(data)[:size]
+
+
+def walk_files(pool, filehash, seen=None, mark=None, skipped=None):
     """Add all files in the given pool to the filehash.
 
     Walks the entire file system directory by directory creating ZFileInfo
     objects from all of the found files and adding them to the ZFileHash
-    filehash.
+    filehash. The filehash is flushed before returning, even if the walk
+    fails, so that every file found is added to it.
+
+    The walk keeps a stack of the directories being walked rather than
+    recursing, so the depth of the tree is not limited by the recursion
+    limit. Files are found in the same order as a recursive walk.
+
+    When walking several txgs of the same pool, a set of seen file
+    identities can be kept between walks. Files whose identity was already
+    seen in an earlier walk are skipped without being hashed, so only the
+    files that changed between txgs are read. If the walk fails, the
+    identities of the files the filehash did not keep are removed from the
+    set again, so that a later walk still adds them.
 
     Args:
         pool: The loaded pool to walk.
         filehash: A ZFileHash object to add the found files to.
+        seen: A set of the identities of files found by earlier walks, see
+            ZFileInfo.identity. The identities of the files found are added
+            to it. If None every file found is added to the filehash.
+        mark: Function called with the first sector and the number of
+            sectors of each block of the files found, see mark_blocks. If
+            None the blocks of files are not marked.
+        skipped: A list to append the (identity, name, obj_id) of each file
+            skipped because it was seen to. If None skipped files are not
+            recorded.
     """
 
-    def _walk_dir(zdir):
-        """Walk the given directory adding ZFileInfo objects to the filehash.
+    def _add_file(zobj, zobj_id):
+        """Add a file to the filehash unless it was seen before.
 
         Args:
-            zdir: The directory to walk.
+            zobj: The file to add.
+            zobj_id: The object id of the file.
         """
 
-        for item in zdir.entries.keys():
-            path.append(item)
+        if mark is not None:
+            mark_blocks(vdev_tree, zobj.dnode, mark)
+
+        zfileinfo = ZFileInfo(zobj, '_'.join(path), zobj_id)
 
-            zobj_id = zdir.get_child(item)
-            zobj = zfs.open_obj(zobj_id)
-            zobj.read()
+        key = zfileinfo.identity()
 
-            if isinstance(zobj, zfspy.zpl.ZDir):
-                _walk_dir(zobj)
-            elif isinstance(zobj, zfspy.zpl.ZFile):
-                zfilename = '_'.join(path)
-                zfileinfo = ZFileInfo(zobj, zfilename)
-                filehash.add(zfileinfo)
+        if seen is not None and key is not None:
+            if key in seen:
+                STATS.add('files_unchanged')
 
-            path.pop()
+                if skipped is not None:
+                    skipped.append((key, zfileinfo.name, zobj_id))
+                return
+
+            seen.add(key)
+            found.append(key)
+
+        filehash.add(zfileinfo)
 
     path = []
+    found = []
 
+    vdev_tree = pool.spa.labelbest.data.vdev_tree
     zfs = pool.dsl_dir.head_dataset.active_fs
     root = zfs.open('/')
     root.read()
-    _walk_dir(root)
 
+    stack = [_open_children(zfs, root)]
+
+    try:
+        try:
+            while stack:
+                for item, zobj_id, zobj in stack[-1]:
+                    if isinstance(zobj, zfspy.zpl.ZDir):
+                        path.append(item)
+                        stack.append(_open_children(zfs, zobj))
+                        break
+                    elif isinstance(zobj, zfspy.zpl.ZFile):
+                        path.append(item)
+                        STATS.add('files_walked')
+                        _add_file(zobj, zobj_id)
+                        path.pop()
+                else:
+                    stack.pop()
+
+                    if path:
+                        path.pop()
+        finally:
+            filehash.flush()
+    except Exception:
+        # Files discarded by the filehash after a hashing error were never
+        # kept, so they must not be skipped by later walks.
+        if seen is not None:
+            seen.difference_update([key for key in found
+                                    if key not in filehash.identities])
+
+        raise
+
+
+def _open_children(zfs, zdir):
+    """A generator that opens the entries of a directory.
+
+    Entries are opened a batch at a time in order of their object ids, so
+    that the dnodes of the batch are read from the object set in the order
+    they are stored and each dnode block is read once while it is cached.
+    The opened objects are yielded in the order of the directory entries.
+
+    An error opening an entry is raised once the entries before it have
+    been yielded, so the same entries are found as when they are opened
+    one at a time.
+
+    Args:
+        zfs: The file system the directory belongs to.
+        zdir: The directory to open the entries of.
+
+    Yields:
+        Tuples of (name, obj_id, zobj) for each entry of the directory.
+    """
+
+    items = list(zdir.entries.keys())
+
+    for pos in xrange(0, len(items), WALK_BATCH):
+        batch = [(zdir.get_child(item), item)
+                 for item in items[pos:pos + WALK_BATCH]]
+        zobjs = {}
+        errors = {}
+
+        for zobj_id, item in sorted(batch):
+            try:
+                zobj = _open_obj(zfs, zobj_id)
+            except Exception as error:
+                errors[item] = error
+                continue
+
+            zobjs[item] = zobj
+
+        for zobj_id, item in batch:
+            if item in errors:
+                raise errors[item]
+
+            yield item, zobj_id, zobjs[item]
+
+
+def load_file(pool, obj_id, name=None):
+    """Load a file from a pool by its object id.
+
+    Args:
+        pool: The loaded pool to load the file from.
+        obj_id: The object id of the file.
+        name: The name associated with the file.
+
+    Returns:
+        A ZFileInfo object for the file.
+    """
+
+    zfs = pool.dsl_dir.head_dataset.active_fs
+    zobj = _open_obj(zfs, obj_id)
+
+    return ZFileInfo(zobj, name, obj_id)
+
+
+def _open_obj(zfs, obj_id):
+    """Open an object of a file system without reading file contents.
+
+    ZFile.read() reads the whole contents of a file, so only directories
+    are read. The znode of a file is parsed from the bonus of its dnode, as
+    get_file_from_dnode does, and its contents are only read when the file
+    is hashed or written.
+
+    Args:
+        zfs: The file system the object belongs to.
+        obj_id: The object id of the object.
+
+    Returns:
+        The opened zfspy object.
+    """
+
+    zobj = zfs.open_obj(obj_id)
+
+    if isinstance(zobj, zfspy.zpl.ZFile):
+        zobj.znode = zfspy.ZNode(zobj.dnode.bonus)
+    else:
+        zobj.read()
+
+    return zobj
+
+
+# Pool settings of an uber walk worker process, set by _init_walk_worker.
+_walk_worker = {}
+
+
+def _init_walk_worker(vdev_info, algorithm, hash_jobs, spool_dir, depth):
+    """Initialize an uber walk worker process.
+
+    Args:
+        vdev_info: The VDev information of the ZFS pool.
+        algorithm: The name of the hashlib algorithm to hash files with.
+        hash_jobs: The number of threads to hash files with.
+        spool_dir: Directory to save the data of hashed files in.
+        depth: The number of blocks of a file to read ahead while hashing.
+    """
+
+    _walk_worker.update(vdev_info=vdev_info, algorithm=algorithm,
+                        hash_jobs=hash_jobs, spool_dir=spool_dir,
+                        seen=set(), depth=depth)
+    STATS.reset()
+
+
+def _walk_txg(txg):
+    """Walk the files of a txg in a worker process.
+
+    ZFile objects are not sent back to the parent process. Instead the
+    identity, name and object id of every file found is returned, along with
+    any hashes of the file that were generated and the temporary file its
+    data was saved to, so that the parent process can load the files from
+    the txg without reading them again, and only loads the files whose
+    identity it does not know.
+
+    Files the worker skips because it found them in an earlier txg are
+    returned too, without hashes, so that the parent can still load them
+    from this txg if it failed to load them from the earlier one.
+
+    Args:
+        txg: The txg to load and walk.
+
+    Returns:
+        A tuple of (txg, error, files, counters). error is None if the walk
+        completed, 'fat_zap' if a fat ZAP was found and 'error' if the walk
+        failed for any other reason. files is a list of (identity,
+        partial, digest, spool, name, obj_id) tuples for the files found
+        before the walk completed or failed, in the order they were added,
+        followed by the skipped files. counters are the Stats counters
+        collected while walking.
+    """
+
+    filehash = ZFileHash(algorithm=_walk_worker['algorithm'],
+                         jobs=_walk_worker['hash_jobs'],
+                         spool_dir=_walk_worker['spool_dir'],
+                         read_ahead=_walk_worker['depth'])
+    skipped = []
+    error = None
+
+    try:
+        pool = zfspy.ZPool(_walk_worker['vdev_info'])
+        pool.load(txg)
+        walk_files(pool, filehash, _walk_worker['seen'], skipped=skipped)
+    except NotImplementedError:
+        error = 'fat_zap'
+    except Exception:
+        error = 'error'
+    finally:
+        filehash.close()
+
+    files = [(zfileinfo.identity(), zfileinfo.partial, zfileinfo.digest,
+              zfileinfo.spool, zfileinfo.name, zfileinfo.obj_id)
+             for zfileinfo in filehash.zfiles()]
+    files.extend((key, None, None, None, name, obj_id)
+                 for key, name, obj_id in skipped)
+
+    return txg, error, files, STATS.take()
+
+
+def walk_txgs(vdev_info, txgs, jobs, algorithm='sha256', hash_jobs=1,
+              spool_dir=None, depth=0):
+    """Walk the files of several txgs concurrently.
 
-def dnode_scan(disk, vdev_tree, sector_map):
+    Each txg is loaded and walked by a pool of worker processes. Results are
+    yielded in the order of the given txgs regardless of the order in which
+    the walks complete. The Stats counters of the workers are merged as
+    their results are yielded.
+
+    Each worker skips hashing the files it already found in an earlier txg
+    and returns them without hashes, see _walk_txg. Workers take txgs in
+    the order they are given, so a file that is skipped was returned with
+    an earlier txg.
+
+    Args:
+        vdev_info: The VDev information of the ZFS pool.
+        txgs: A list of the txgs to walk.
+        jobs: The number of processes to walk with.
+        algorithm: The name of the hashlib algorithm to hash files with.
+        hash_jobs: The number of threads each process hashes files with.
+        spool_dir: Directory to save the data of hashed files in. If None
+            the data is not saved.
+        depth: The number of blocks of a file to read ahead while hashing.
+
+    Yields:
+        A tuple of (txg, error, files) for each txg, see _walk_txg.
+    """
+
+    pool = multiprocessing.Pool(jobs, _init_walk_worker,
+                                (vdev_info, algorithm, hash_jobs, spool_dir,
+                                 depth))
+
+    try:
+        for txg, error, files, counters in pool.imap(_walk_txg, txgs):
+            STATS.merge(counters)
+            yield txg, error, files
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _scan_windows(runs, window_size):
+    """Split runs of sectors into aligned scan windows.
+
+    Each run is split on multiples of the window size so that no window
+    is larger than window_size bytes and windows of neighbouring runs line
+    up with each other on disk.
+
+    Args:
+        runs: An iterable of (start, length) runs of sectors.
+        window_size: The maximum size of a window in bytes.
+
+    Yields:
+        Tuples of (start, length) for each window, in sectors.
+    """
+
+    window_sectors = max(window_size / SECTOR_SIZE, 1)
+
+    for start, length in runs:
+        end = start + length
+
+        while start < end:
+            boundary = (start / window_sectors + 1) * window_sectors
+            stop = min(end, boundary)
+            yield start, stop - start
+            start = stop
+
+
+def _shard_runs(runs, shard_sectors):
+    """Split runs of sectors into shards of equal size.
+
+    Runs are split across shards where needed so that every shard, except
+    possibly the last, covers exactly shard_sectors sectors.
+
+    Args:
+        runs: An iterable of (start, length) runs of sectors.
+        shard_sectors: The number of sectors in each shard.
+
+    Yields:
+        Lists of (start, length) runs making up each shard.
+    """
+
+    shard = []
+    count = 0
+
+    for start, length in runs:
+        while length:
+            take = min(length, shard_sectors - count)
+            shard.append((start, take))
+            start += take
+            length -= take
+            count += take
+
+            if count == shard_sectors:
+                yield shard
+                shard = []
+                count = 0
+
+    if shard:
+        yield shard
+
+
+def _read_windows(disk, runs, window_size, use_mmap):
+    """Read runs of sectors from disk a window at a time.
+
+    Each window is read with one extra sector at its end so that data
+    starting in the last sector of a window can still be decompressed in
+    full.
+
+    Args:
+        disk: The disk to read from.
+        runs: An iterable of (start, length) runs of sectors to read.
+        window_size: The number of bytes to read from disk at a time.
+        use_mmap: If True, memory map the disk instead of reading it.
+
+    Yields:
+        Tuples of (start, length, data) for each window read.
+    """
+
+    file_ = open(disk, 'rb')
+
+    if use_mmap:
+        disk_map = mmap.mmap(file_.fileno(), get_dev_size(disk),
+                             access=mmap.ACCESS_READ)
+
+    try:
+        for start, length in _scan_windows(runs, window_size):
+            offset = start * SECTOR_SIZE
+            size = (length + 1) * SECTOR_SIZE
+
+            if use_mmap:
+                data = disk_map[offset:offset + size]
+            else:
+                file_.seek(offset)
+                data = file_.read(size)
+
+            STATS.add('scan_bytes_read', len(data))
+            yield start, length, data
+    finally:
+        if use_mmap:
+            disk_map.close()
+        file_.close()
+
+
+def _parse_dnodes(vdev_tree, data):
+    """Parse the dnodes from a block of compressed data.
+
+    Args:
+        vdev_tree: The VDev information for the ZFS pool.
+        data: The data starting at the sector to parse.
+
+    Returns:
+        A list of (record, dnode) tuples, one for every zfspy.DNode that
+        could be parsed from the data along with the raw dnode it was
+        parsed from.
+    """
+
+    dnodes = []
+    decomp_data = zfspy.compress.lzjb_decompress(data)
+
+    if not decomp_data:
+        return dnodes
+
+    STATS.add('lzjb_successes')
+    chunks = len(decomp_data) / DNODE_SIZE
+
+    for ii in xrange(0, chunks):
+        record = zfspy.util.get_record(decomp_data, DNODE_SIZE, ii)
+
+        if not _plausible_dnode(record):
+            continue
+
+        try:
+            dnode = zfspy.DNode(vdev_tree, record)
+        except Exception:
+            continue
+        else:
+            if dnode.type != 'DMU_OT_NONE':
+                dnodes.append((record, dnode))
+
+    if dnodes:
+        STATS.add('dnodes_parsed', len(dnodes))
+
+    return dnodes
+
+
+def _plausible_dnode(record):
+    """Check the fields of a raw dnode before it is parsed.
+
+    Dnodes that are not in use, and dnodes whose type, levels, block
+    pointers or bonus buffer are out of the ranges ZFS creates them with,
+    are rejected without creating a zfspy.DNode.
+
+    Args:
+        record: The raw dnode.
+
+    Returns:
+        True if the dnode could be a dnode in use.
+    """
+
+    if len(record) < DNODE_CORE_SIZE:
+        return False
+
+    kind, indblkshift, nlevels, nblkptr, bonuslen = struct.unpack_from(
+        '<4B6xH', record)
+
+    return (kind != 0 and
+            DNODE_MIN_INDBLKSHIFT <= indblkshift <= DNODE_MAX_INDBLKSHIFT and
+            1 <= nlevels <= DNODE_MAX_LEVELS and
+            1 <= nblkptr <= DNODE_MAX_BLKPTR and
+            bonuslen <= DNODE_SIZE - DNODE_CORE_SIZE - nblkptr * BLKPTR_SIZE)
+
+
+def _candidate_sectors(data, length):
+    """Find the sectors of a window that could start compressed dnodes.
+
+    A sector whose scan read is all zeros decompresses to empty dnodes only,
+    so runs of zeros are skipped by searching for the next non zero byte
+    instead of testing every sector. A sector whose first byte marks a back
+    reference before the start of the output is not the start of LZJB data
+    and is skipped as well.
+
+    Args:
+        data: The data of the window.
+        length: The number of sectors in the window.
+
+    Yields:
+        The index of each sector within the window to decompress.
+    """
+
+    overlap = SCAN_READ_SIZE / SECTOR_SIZE - 1
+    ii = 0
+
+    while ii < length:
+        match = _NONZERO.search(data, ii * SECTOR_SIZE)
+
+        if match is None:
+            return
+
+        ii = max(ii, match.start() / SECTOR_SIZE - overlap)
+
+        if ii >= length:
+            return
+
+        if not ord(data[ii * SECTOR_SIZE]) & 1:
+            yield ii
+
+        ii += 1
+
+
+def _scan_runs(disk, vdev_tree, runs, window_size, use_mmap, types=None,
+               depth=0):
+    """Scan runs of sectors for dnodes.
+
+    Windows are read ahead of the one being scanned by a thread, so that the
+    disk is read while the sectors already read are decompressed and parsed.
+
+    Args:
+        disk: The disk to scan for dnodes.
+        vdev_tree: The VDev information for the ZFS pool.
+        runs: An iterable of (start, length) runs of sectors to scan.
+        window_size: The number of bytes to read from disk at a time.
+        use_mmap: If True, memory map the disk instead of reading it.
+        types: The dnode types to find. If None dnodes of every type are
+            found.
+        depth: The number of windows to read ahead, see read_ahead.
+
+    Yields:
+        Tuples of (end, count, found) for each window scanned, in disk
+        order, where end is the sector following the window, count is the
+        number of sectors scanned and found is a list of (record, dnode)
+        tuples of the dnodes found in the window.
+    """
+
+    windows = read_ahead(_read_windows(disk, runs, window_size, use_mmap),
+                         depth)
+
+    for start, length, data in windows:
+        found = []
+        attempts = 0
+
+        for ii in _candidate_sectors(data, length):
+            pos = ii * SECTOR_SIZE
+            attempts += 1
+
+            for record, dnode in _parse_dnodes(
+                    vdev_tree, data[pos:pos + SCAN_READ_SIZE]):
+                if types is None or dnode.type in types:
+                    found.append((record, dnode))
+
+        STATS.add('sectors_scanned', length)
+        STATS.add('lzjb_attempts', attempts)
+        yield start + length, length, found
+
+
+def _skip_runs(runs, sector):
+    """Drop the parts of runs of sectors before a given sector.
+
+    Args:
+        runs: An iterable of (start, length) runs of sectors.
+        sector: The first sector to keep.
+
+    Yields:
+        Tuples of (start, length) for the runs at or after the sector.
+    """
+
+    for start, length in runs:
+        if start + length <= sector:
+            continue
+
+        if start < sector:
+            length -= sector - start
+            start = sector
+
+        yield start, length
+
+
+# Scan settings of a brute scan worker process, set by _init_scan_worker.
+_scan_worker = {}
+
+
+def _init_scan_worker(disk, vdev_tree, window_size, use_mmap, types,
+                      depth):
+    """Initialize a brute scan worker process.
+
+    Args:
+        disk: The disk to scan for dnodes.
+        vdev_tree: The VDev information for the ZFS pool.
+        window_size: The number of bytes to read from disk at a time.
+        use_mmap: If True, memory map the disk instead of reading it.
+        types: The dnode types to find, or None for every type.
+        depth: The number of windows to read ahead.
+    """
+
+    _scan_worker.update(disk=disk, vdev_tree=vdev_tree,
+                        window_size=window_size, use_mmap=use_mmap,
+                        types=types, depth=depth)
+    STATS.reset()
+
+
+def _scan_shard(shard):
+    """Scan a shard of sectors for dnodes in a worker process.
+
+    DNode objects are not sent back to the parent process, only the raw
+    dnodes they were parsed from.
+
+    Args:
+        shard: A list of (start, length) runs of sectors to scan.
+
+    Returns:
+        A tuple of (end, count, records, counters) where end is the sector
+        following the shard, count is the number of sectors scanned, records
+        is a list of the raw dnodes found, in disk order, and counters are
+        the Stats counters collected while scanning.
+    """
+
+    records = []
+    windows = _scan_runs(_scan_worker['disk'], _scan_worker['vdev_tree'],
+                         shard, _scan_worker['window_size'],
+                         _scan_worker['use_mmap'], _scan_worker['types'],
+                         _scan_worker['depth'])
+
+    for _, _, found in windows:
+        records.extend(record for record, _ in found)
+
+    start, length = shard[-1]
+    count = sum(length for _, length in shard)
+    return start + length, count, records, STATS.take()
+
+
+def dnode_scan(disk, vdev_tree, sector_map, window_size=SCAN_WINDOW,
+               use_mmap=False, jobs=1, journal=None, types=None,
+               depth=READ_AHEAD):
     """Scans for dnodes on a given disk.
 
     Scanning is performed on the disk given to locate ZFS dnodes. The
     sector_map provides a mapping of sectors to search (those that have not
-    been set). Each bit in the sector_map cooresponds to a sector on disk. Once
-    the data is read from disk it decompressed. Currently the only supported
-    form of compression for dnodes is LZJB. If the decompression yeilds usable
-    data dnodes are created from that data. If the dnode created is valid then
-    it is added to the list of parsed dnodes. The list is then returned.
+    been set). Each bit in the sector_map cooresponds to a sector on disk.
+
+    Runs of unset sectors are read from disk a window at a time, either
+    through a buffered read or a memory map of the disk, instead of reading
+    every sector individually. A few windows are read ahead by a thread
+    while the current window is scanned.
+
+    Once the data is read from disk it decompressed. Currently the only
+    supported form of compression for dnodes is LZJB. If the decompression
+    yeilds usable data dnodes are created from that data. If the dnode
+    created is valid then it is yielded as soon as the window it was found
+    in has been scanned, so the dnodes found are never all held in memory.
+
+    Sectors that cannot start compressed dnodes, such as runs of zeros, are
+    skipped before decompression, and raw dnodes whose fields are out of
+    range are skipped before a zfspy.DNode is created from them. When types
+    are given, dnodes of other types are dropped as soon as they are parsed.
+
+    When more than one job is requested the runs of unset sectors are split
+    into equal sized shards that are scanned by a pool of worker processes.
+    Only a few shards are scanned ahead of the dnodes being used, and shard
+    results are collected in disk order so the dnodes yielded are the same
+    as those of a scan with a single job.
+
+    When a journal is given the dnodes already recorded in it are yielded
+    first, and the scan continues from the sector the journal was left at.
+    The progress of the scan is recorded in the journal after every window,
+    or every shard when scanning with more than one job. The journal is left
+    open for the caller to close.
+
+    The progress of the scan is reported through the Stats of the run.
 
     Args:
         disk: The disk to scan for dnodes.
         vdev_tree: The VDev information for the ZFS pool.
         sector_map: A SectorMap of sectors not to scan.
+        window_size: The number of bytes to read from disk at a time.
+        use_mmap: If True, memory map the disk instead of reading it.
+        jobs: The number of processes to scan with.
+        journal: A ScanJournal to resume the scan from and record its
+            progress in. If None the scan is not journaled.
+        types: The dnode types to find. If None dnodes of every type other
+            than DMU_OT_NONE are found.
+        depth: The number of windows to read ahead of the window being
+            scanned. If 0 windows are read as they are scanned.
 
-    Returns:
-        A list of zfspy.DNode objects that were parsed from the disk.
+    Yields:
+        zfspy.DNode objects that were parsed from the disk, in disk order.
     """
 
-    file_ = open(disk, 'rb')
-    dnodes = []
+    for batch in dnode_scan_batches(disk, vdev_tree, sector_map,
+                                    window_size, use_mmap, jobs, journal,
+                                    types, depth):
+        for dnode in batch:
+            yield dnode
 
-    for sector in sector_map.unset_gen():
-        offset = sector * SECTOR_SIZE
-        file_.seek(offset)
 
-        data = file_.read(1024)
-        decomp_data = zfspy.compress.lzjb_decompress(data)
+def dnode_scan_batches(disk, vdev_tree, sector_map, window_size=SCAN_WINDOW,
+                       use_mmap=False, jobs=1, journal=None, types=None,
+                       depth=READ_AHEAD):
+    """Scans for dnodes on a given disk a batch at a time.
 
-        if not decomp_data:
-            continue
+    See dnode_scan, which takes the same arguments.
 
-        chunks = len(decomp_data) / DNODE_SIZE
+    Yields:
+        Lists of the zfspy.DNode objects parsed from each window, or each
+        shard when scanning with more than one job, in disk order. Lists
+        may be empty.
+    """
 
-        for ii in xrange(0, chunks):
+    start = 0
 
-            try:
-                dnode = zfspy.DNode(
-                    vdev_tree,
-                    zfspy.util.get_record(decomp_data, DNODE_SIZE, ii)
-                    )
-            except Exception:
-                continue
-            else:
-                if dnode.type != 'DMU_OT_NONE':
-                    dnodes.append(dnode)
+    if journal is not None:
+        for records in journal.replay():
+            yield [zfspy.DNode(vdev_tree, record) for record in records]
 
-    return dnodes
+        start = journal.sector
+
+    runs = _skip_runs(sector_map.unset_runs(), start)
+    total = sum(length for _, length in
+                _skip_runs(sector_map.unset_runs(), start))
+    done = 0
+
+    STATS.start_progress('brute', total, 'sectors')
+
+    if jobs <= 1:
+        windows = _scan_runs(disk, vdev_tree, runs, window_size, use_mmap,
+                             types, depth)
+
+        for end, count, found in windows:
+            if journal is not None:
+                journal.checkpoint(end, [record for record, _ in found])
+
+            done += count
+            STATS.progress(done)
+            yield [dnode for _, dnode in found]
+
+        return
+
+    shards = _shard_runs(runs, SCAN_SHARD / SECTOR_SIZE)
+    pool = multiprocessing.Pool(jobs, _init_scan_worker,
+                                (disk, vdev_tree, window_size, use_mmap,
+                                 types, depth))
+    pending = collections.deque()
+
+    try:
+        while True:
+            # Keep a bounded number of shards queued so that results are not
+            # collected faster than they are used.
+            for shard in shards:
+                pending.append(pool.apply_async(_scan_shard, (shard,)))
+
+                if len(pending) >= jobs * SCAN_QUEUE:
+                    break
+
+            if not pending:
+                break
+
+            end, count, records, counters = pending.popleft().get()
+            STATS.merge(counters)
+
+            if journal is not None:
+                journal.checkpoint(end, records)
+
+            done += count
+            STATS.progress(done)
+            yield [zfspy.DNode(vdev_tree, record) for record in records]
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,24 +1,93 @@
+import collections
 import hashlib
 import logging
+import os
+import tempfile
+
+from multiprocessing.pool import ThreadPool
+
+from .stats import STATS
+from .zfileinfo import WrittenZFileInfo
+
+# Digest algorithms that can be used to generate keys.
+DIGESTS = tuple(name for name in ('sha256', 'blake2b')
+                if name in hashlib.algorithms_available)
+
+HASH_QUEUE = 4  # Files waiting to be hashed per hashing thread
+PARTIAL_SIZE = 131072  # Bytes at each end of a file in its partial hash
 
 
 class ZFileHash(dict):
-    """Dictionary that creates keys based on contents of the ZFile.
+    """Dictionary of ZFiles that prevents duplicate contents.
+
+    A ZFileHash stores ZFiles in a dictionary keyed by the size of the ZFile,
+    each value being a list of the ZFiles of that size. A ZFileHash also
+    prevents multiple files with the same data from being added into the
+    dictionary.
 
-    A ZFileHash stores ZFiles in a dictionary with a key that is based off of a
-    sha256 hash of the ZFile data. A ZFileHash also prevents multiple files
-    with the same data from being added into the dictionary.
+    Files are compared in tiers so that as little data as possible is read.
+    A file whose identity, made from the checksums of its block pointers,
+    matches a file that was already given is discarded without being read.
+    Files without an identity, such as files written with checksums turned
+    off, are only compared by the tiers below.
+    A file whose size matches no other file is added without being read.
+    When sizes match, a partial hash of the first and last bytes of the
+    files is compared, and only files whose partial hashes also match have
+    their full contents hashed. Hashes are kept on the ZFileInfo objects so
+    that no file is hashed twice.
+
+    The ZFile data is hashed a block at a time so that files of any size can
+    be hashed without reading them into memory. When a spool_dir is given the
+    data is also written to a temporary file there while it is hashed, so
+    that a file that is added can be saved without being read again. The
+    temporary file is removed if the file is not added. When more than one
+    job is
+    given the files are hashed by a pool of threads, and are added to the
+    dictionary in the order they were given once they have been hashed.
+
+    A ZFileHash that is only used to exclude files, such as the files of the
+    current file system, can be made not to compare the files given to it.
+    Every file is then added by its identity without any of it being read,
+    and a file is only read if a file compared against the excludes has the
+    same size but a different identity.
+
+    Once a ZFile has been written out it can be released, which replaces it
+    with a WrittenZFileInfo so that the ZFileHash does not keep the zfspy
+    objects of every file it has added.
     """
 
-    def __init__(self, exclude=None):
+    def __init__(self, exclude=None, algorithm='sha256', jobs=1,
+                 on_add=None, spool_dir=None, read_ahead=0, compare=True):
         """Initialize ZFileHash.
 
         Args:
             exclude: ZFileHash of objects not to exclude from this ZFileHash.
+            algorithm: The name of the hashlib algorithm to hash files with.
+            jobs: The number of threads to hash files with.
+            on_add: Function called with each ZFile that add() adds to the
+                dictionary, in the order they are added.
+            spool_dir: Directory to write the data of hashed files to. If
+                None the data is not kept.
+            read_ahead: The number of blocks of a file to read ahead of
+                the block being hashed.
+            compare: If False, ZFiles are added by their identity without
+                being compared, see add().
         """
 
         super(ZFileHash, self).__init__()
         self.exclude = exclude
+        self.algorithm = algorithm
+        self.jobs = jobs
+        self.order = []
+        self.positions = {}
+        self.identities = set()
+        self.pending = collections.deque()
+        self.pending_sizes = collections.Counter()
+        self.pool = None
+        self.on_add = on_add
+        self.spool_dir = spool_dir
+        self.read_ahead = read_ahead
+        self.compare = compare
         self.log = logging.getLogger(__name__)
 
     def __add__(self, other):
@@ -34,41 +103,382 @@ class ZFileHash(dict):
             A new ZFileHash that is a combination of self, and other.
         """
 
-        fhash = ZFileHash()
-        fhash.update(self)
+        fhash = ZFileHash(algorithm=self.algorithm)
+        fhash.extend(self.zfiles())
+        fhash.identities.update(self.identities)
 
         if other is not None:
-            fhash.update(other)
+            fhash.extend(other.zfiles())
+            fhash.identities.update(other.identities)
 
         return fhash
 
+    def zfiles(self):
+        """Retrieve the ZFiles in the dictionary.
+
+        Returns:
+            A list of the ZFiles in the order they were added.
+        """
+
+        return list(self.order)
+
+    def partial_digest(self, zfile, spool=True):
+        """Generate the partial hash of a ZFile.
+
+        The partial hash covers the first and last PARTIAL_SIZE bytes of
+        the ZFile, whatever its block size, so that ZFiles with the same
+        contents stored in blocks of different sizes have the same partial
+        hash. For files of at most twice that size it covers the whole file,
+        and is the full hash, see digest().
+
+        Args:
+            zfile: The ZFile object to hash.
+            spool: If True and the partial hash covers the whole file, the
+                ZFile data is spooled as by digest().
+
+        Returns:
+            A hex digest of the first and last bytes of the ZFile.
+        """
+
+        if zfile.partial is None:
+            size = zfile.size()
+
+            if size <= 2 * PARTIAL_SIZE:
+                zfile.partial = self.digest(zfile, spool)
+                return zfile.partial
+
+            zfile_hash = hashlib.new(self.algorithm)
+            hashed = 0
+
+            with STATS.timer('hash'):
+                for offset in (0, size - PARTIAL_SIZE):
+                    data = zfile.read_range(offset, PARTIAL_SIZE)
+                    zfile_hash.update(data)
+                    hashed += len(data)
+
+            STATS.add('bytes_hashed', hashed)
+            zfile.partial = zfile_hash.hexdigest()
+
+        return zfile.partial
+
+    def digest(self, zfile, spool=True):
+        """Generate the hash of a ZFile.
+
+        Args:
+            zfile: The ZFile object to hash.
+            spool: If True and a spool_dir was given, the ZFile data is
+                written to a temporary file while it is hashed.
+
+        Returns:
+            A hex digest of the ZFile contents.
+        """
+
+        if zfile.digest is not None:
+            return zfile.digest
+
+        zfile_hash = hashlib.new(self.algorithm)
+        hashed = 0
+
+        if not spool or self.spool_dir is None:
+            with STATS.timer('hash'):
+                for data in zfile.read_blocks(self.read_ahead):
+                    zfile_hash.update(data)
+                    hashed += len(data)
+
+            STATS.add('bytes_hashed', hashed)
+            zfile.digest = zfile_hash.hexdigest()
+            return zfile.digest
+
+        fd, spool_path = tempfile.mkstemp(prefix='.zfinds-', suffix='.tmp',
+                                          dir=self.spool_dir)
+
+        with os.fdopen(fd, 'wb') as file_, STATS.timer('hash'):
+            try:
+                for data in zfile.read_blocks(self.read_ahead):
+                    zfile_hash.update(data)
+                    file_.write(data)
+                    hashed += len(data)
+            except Exception:
+                os.unlink(spool_path)
+                raise
+
+        STATS.add('bytes_hashed', hashed)
+        STATS.add('bytes_written', hashed)
+        zfile.spool = spool_path
+        zfile.digest = zfile_hash.hexdigest()
+        return zfile.digest
+
     def add(self, zfile):
         """Add a ZFile to the dictionary.
 
-        Before adding the file to the dictionary, the ZFile contents are read
-        and hashed to generate a key. The dictionary is then checked to make
-        sure the key does not already exist before adding the ZFile.
+        Before adding the file to the dictionary, the ZFile is compared to
+        the files of the same size in the dictionary and in the excludes, to
+        make sure its contents do not already exist.
+
+        When hashing with more than one job the ZFile may not have been added
+        when this returns, see flush().
+
+        When the ZFileHash does not compare ZFiles, the ZFile is added with
+        its identity and nothing is read.
+
+        Args:
+            zfile: The ZFileInfo object to add to the dictionary.
+        """
+
+        if not self.compare:
+            zfile.identity()
+            STATS.add('files_identified')
+            self._append(zfile)
+            return
+
+        if self._seen(zfile):
+            self.log.debug('Size: %s - File identity exists', zfile.size())
+            STATS.add('files_identical')
+            self._discard(zfile)
+            return
+
+        if zfile.identity() is not None:
+            self.identities.add(zfile.identity())
+
+        if self.jobs <= 1:
+            self.flush()
+            self._insert(zfile)
+            return
+
+        if self.pool is None:
+            self.pool = ThreadPool(self.jobs)
+
+        size = zfile.size()
+        collides = self.pending_sizes[size] > 0 or bool(self._same_size(size))
+
+        result = self.pool.apply_async(self._prehash, (zfile, collides))
+        self.pending.append((zfile, result))
+        self.pending_sizes[size] += 1
+        self._drain(self.jobs * HASH_QUEUE)
+
+    def extend(self, zfiles):
+        """Add ZFiles to the dictionary without comparing them.
+
+        Used for ZFiles that are already known to have distinct contents,
+        such as the contents of another ZFileHash.
+
+        Args:
+            zfiles: An iterable of ZFileInfo objects to add.
+        """
+
+        self.flush()
+
+        for zfile in zfiles:
+            self._append(zfile)
+
+    def release(self, zfile, path):
+        """Replace a ZFile that has been written with a WrittenZFileInfo.
+
+        May be called from the threads that write the ZFiles.
+
+        Args:
+            zfile: The ZFileInfo object in the dictionary.
+            path: The path the contents of the ZFile were written to.
+        """
+
+        record = WrittenZFileInfo(zfile, path)
+        same_size = self[record.size()]
+
+        self.order[self.positions.pop(id(zfile))] = record
+        same_size[same_size.index(zfile)] = record
+
+    def flush(self):
+        """Wait for all pending ZFiles to be hashed and added.
+
+        If hashing a ZFile raised an error, the ZFiles given after it are
+        discarded and the error is raised. The identities of the discarded
+        ZFiles are forgotten, so that they can be given again.
+        """
+
+        self._drain(0)
+
+    def close(self):
+        """Flush pending ZFiles and stop the hashing threads."""
+
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def _seen(self, zfile):
+        """Check whether a ZFile with the same identity was already given.
+
+        Every ZFile given to add() has its identity recorded, whether it was
+        added or not, since a later ZFile with the same identity would be a
+        duplicate of it either way.
+
+        Args:
+            zfile: The ZFileInfo object to check.
+
+        Returns:
+            True if the identity of the ZFile is known to this ZFileHash or
+            to the excludes. False if the ZFile has no identity.
+        """
+
+        return self.has_identity(zfile.identity())
+
+    def has_identity(self, identity):
+        """Check whether a ZFile identity is known.
+
+        Args:
+            identity: The identity to check, see ZFileInfo.identity.
+
+        Returns:
+            True if the identity is known to this ZFileHash or to the
+            excludes. False if the identity is None.
+        """
+
+        if identity is None:
+            return False
+
+        if identity in self.identities:
+            return True
+
+        return self.exclude is not None and identity in self.exclude.identities
+
+    def _same_size(self, size):
+        """Retrieve the known ZFiles of a given size.
+
+        Args:
+            size: The size of the ZFiles.
+
+        Returns:
+            A list of (zfile, source) tuples of the ZFiles of the given size
+            in the dictionary and in the excludes.
+        """
+
+        same = [(zfile, 'self') for zfile in self.get(size, [])]
+
+        if self.exclude is not None:
+            same.extend((zfile, 'excludes')
+                        for zfile in self.exclude.get(size, []))
+
+        return same
+
+    def _prehash(self, zfile, collides):
+        """Hash a ZFile ahead of it being added.
+
+        Runs in a hashing thread. Only the hashes that are likely to be
+        needed when the ZFile is added are generated; any others are
+        generated when it is added.
+
+        Args:
+            zfile: The ZFileInfo object to hash.
+            collides: True if a ZFile of the same size was known when the
+                ZFile was given.
+        """
+
+        if not collides:
+            return
+
+        partial = self.partial_digest(zfile)
+
+        for other, _ in self._same_size(zfile.size()):
+            if other.partial == partial:
+                self.digest(zfile)
+                return
+
+    def _drain(self, limit):
+        """Add hashed ZFiles in the order they were given.
+
+        Args:
+            limit: The number of ZFiles that may be left pending. ZFiles
+                that are already hashed are added regardless.
+        """
+
+        while self.pending:
+            zfile, result = self.pending[0]
+
+            if len(self.pending) <= limit and not result.ready():
+                break
+
+            self.pending.popleft()
+            self.pending_sizes[zfile.size()] -= 1
+
+            try:
+                result.get()
+                self._insert(zfile)
+            except Exception:
+                self._discard(zfile)
+                self.identities.discard(zfile.identity())
+
+                for zfile, result in self.pending:
+                    result.wait()
+                    self._discard(zfile)
+                    self.identities.discard(zfile.identity())
+
+                self.pending.clear()
+                self.pending_sizes.clear()
+                raise
+
+    def _insert(self, zfile):
+        """Add a ZFile to the dictionary unless its contents already exist.
+
+        The data of a ZFile already in the dictionary is only spooled while
+        hashing it if it has not been handed to on_add, which may be
+        writing it out, and has not been released.
+
+        Args:
+            zfile: The ZFileInfo object to add to the dictionary.
+        """
+
+        size = zfile.size()
+
+        self.log.debug('Size: %s - Attempting to add file', size)
+
+        for other, source in self._same_size(size):
+            spool = (source == 'self' and self.on_add is None and
+                     not isinstance(other, WrittenZFileInfo))
+
+            if (self.partial_digest(other, spool) !=
+                    self.partial_digest(zfile)):
+                continue
+
+            if self.digest(other, spool) == self.digest(zfile):
+                self.log.debug('Digest: %s - File exists in %s',
+                               zfile.digest[:6], source)
+                STATS.add('files_duplicate')
+                self._discard(zfile)
+                return
+
+        self.log.debug('Size: %s - Added file', size)
+        STATS.add('files_added')
+        self._append(zfile)
+
+        if self.on_add is not None:
+            self.on_add(zfile)
+
+    def _discard(self, zfile):
+        """Remove the temporary file of a ZFile that was not added.
 
         Args:
-            zfile: The ZFile object to add to the dictionary.
-        """
-
-        zfile_hash = hashlib.sha256()
-        zfile_hash.update(zfile.read())
-        digest = zfile_hash.hexdigest()
-
-        self.log.debug('Digest: %s - Attempting to add file', digest[:6])
-
-        if digest in self:
-            self.log.debug('Digest: %s - File exists in self', digest[:6])
-        else:
-            if self.exclude:
-                if digest in self.exclude:
-                    self.log.debug('Digest: %s - File exists in excludes',
-                                   digest[:6])
-                else:
-                    self.log.debug('Digest: %s - Added file', digest[:6])
-                    self[digest] = zfile
-            else:
-                self.log.debug('Digest: %s - Added file', digest[:6])
-                self[digest] = zfile
+            zfile: The ZFileInfo object that was not added.
+        """
+
+        if zfile.spool is not None:
+            os.unlink(zfile.spool)
+            zfile.spool = None
+
+    def _append(self, zfile):
+        """Add a ZFile to the dictionary without comparing it.
+
+        Args:
+            zfile: The ZFileInfo object to add to the dictionary.
+        """
+
+        self.setdefault(zfile.size(), []).append(zfile)
+        self.positions[id(zfile)] = len(self.order)
+        self.order.append(zfile)
+
+        # Identities are not computed here, so that ZFiles loaded from a
+        # FileCache are not read from the pool.
+        if zfile.key is not None:
+            self.identities.add(zfile.key)
@@ -1,3 +1,10 @@
+from .readahead import read_ahead
+
+SECTOR_SIZE = 512
+READ_SIZE = 1048576  # Bytes read at a time from a written file
+ZIO_CHECKSUM_OFF = 2
+
+
 class ZFileInfo(object):
     """Container for ZFile and its metadata.
 
@@ -8,18 +15,30 @@ class ZFileInfo(object):
     Attributes:
         zfile: The ZFile object.
         name: The name of the ZFile.
+        obj_id: The object id of the ZFile within its file system.
+        partial: The partial digest of the ZFile once it has been computed.
+        digest: The digest of the ZFile once it has been computed.
+        spool: The path of a temporary file holding the contents of the
+            ZFile, if they were saved while it was hashed.
+        key: The identity of the ZFile once it has been computed.
     """
 
-    def __init__(self, zfile, name=None):
+    def __init__(self, zfile, name=None, obj_id=None):
         """Initialize ZFileInfo.
 
         Args:
             zfile: The ZFile object.
             name: The name associated with the ZFile object.
+            obj_id: The object id of the ZFile within its file system.
         """
 
         self.zfile = zfile
         self.name = name
+        self.obj_id = obj_id
+        self.partial = None
+        self.digest = None
+        self.spool = None
+        self.key = None
 
     def read(self):
         """Read the contents of the ZFile.
@@ -29,3 +48,189 @@ class ZFileInfo(object):
         """
 
         return self.zfile.read()
+
+    def size(self):
+        """Retrieve the size of the ZFile.
+
+        Returns:
+            The size of the ZFile in bytes.
+        """
+
+        return self.zfile.znode.size
+
+    def identity(self):
+        """Retrieve a key identifying the contents of the ZFile.
+
+        The key is made from the size and block size of the ZFile and the
+        checksum algorithm and checksum of each of the top level block
+        pointers of its dnode. The checksum of a block pointer covers the
+        block it points to, so two ZFiles with the same key have the same
+        contents. An indirect block holds the DVAs of the blocks below it,
+        so a ZFile with indirect blocks only shares its key with ZFiles
+        whose blocks are at the same place on disk. Computing the key does
+        not read any data.
+
+        A ZFile has no key if any of its top level block pointers that is
+        not a hole has checksums turned off or an all zero checksum, as the
+        checksums would not tell different contents apart.
+
+        Returns:
+            A hashable tuple identifying the contents of the ZFile, or None
+            if the ZFile has no key.
+        """
+
+        if self.key is None:
+            dnode = self.zfile.dnode
+            checksums = []
+
+            for blkptr in dnode.blkptr:
+                checksum = tuple(blkptr.checksum)
+
+                if blkptr.birth_txg and (blkptr.cksum == ZIO_CHECKSUM_OFF or
+                                         not any(checksum)):
+                    return None
+
+                checksums.append((blkptr.cksum, checksum))
+
+            self.key = (self.size(), dnode.datablkszsec) + tuple(checksums)
+
+        return self.key
+
+    def block_count(self):
+        """Retrieve the number of blocks holding the contents of the ZFile.
+
+        Returns:
+            The number of data blocks of the ZFile.
+        """
+
+        block_size = self.zfile.dnode.datablkszsec * SECTOR_SIZE
+
+        return (self.size() + block_size - 1) / block_size
+
+    def read_block(self, blkid):
+        """Read a single block of the ZFile.
+
+        Args:
+            blkid: The id of the block to read.
+
+        Returns:
+            The contents of the block, truncated to the size of the ZFile.
+        """
+
+        dnode = self.zfile.dnode
+        offset = blkid * dnode.datablkszsec * SECTOR_SIZE
+
+        return dnode.get_blk(blkid)[:max(self.size() - offset, 0)]
+
+    def read_range(self, offset, length):
+        """Read a range of bytes of the ZFile.
+
+        Only the blocks holding the range are read.
+
+        Args:
+            offset: The offset of the first byte to read.
+            length: The number of bytes to read.
+
+        Returns:
+            The bytes of the range, truncated to the size of the ZFile.
+        """
+
+        if length <= 0:
+            return b''
+
+        block_size = self.zfile.dnode.datablkszsec * SECTOR_SIZE
+        first = offset / block_size
+        last = (offset + length - 1) / block_size
+        data = b''.join(self.read_block(blkid)
+                        for blkid in xrange(first, last + 1))
+        start = offset - first * block_size
+
+        return data[start:start + length]
+
+    def read_blocks(self, depth=0):
+        """Read the contents of the ZFile a block at a time.
+
+        Only the block being used and the blocks read ahead of it are held
+        in memory at a time. The last block is truncated to the size of the
+        ZFile.
+
+        Args:
+            depth: The number of blocks to read ahead in a thread while the
+                current block is used, see read_ahead. Files of a single
+                block are always read directly.
+
+        Yields:
+            The contents of each block of the ZFile.
+        """
+
+        count = self.block_count()
+        blocks = (self.read_block(blkid) for blkid in xrange(count))
+
+        return read_ahead(blocks, depth if count > 1 else 0)
+
+
+class WrittenZFileInfo(ZFileInfo):
+    """ZFileInfo of a ZFile whose contents have been written out.
+
+    Keeps only what is needed to compare the ZFile with files found later,
+    its size, hashes and identity, and not the ZFile object with its dnode
+    and znode. The contents are read back from the written file when they
+    have to be hashed.
+
+    Attributes:
+        path: The path the contents of the ZFile were written to.
+    """
+
+    def __init__(self, zfileinfo, path):
+        """Initialize WrittenZFileInfo.
+
+        Args:
+            zfileinfo: The ZFileInfo of the ZFile that was written.
+            path: The path the contents of the ZFile were written to.
+        """
+
+        super(WrittenZFileInfo, self).__init__(None, zfileinfo.name,
+                                               zfileinfo.obj_id)
+        self.partial = zfileinfo.partial
+        self.digest = zfileinfo.digest
+        self.key = zfileinfo.identity()
+        self.path = path
+        self.written_size = zfileinfo.size()
+
+    def size(self):
+        """Retrieve the size of the ZFile.
+
+        Returns:
+            The size of the ZFile in bytes.
+        """
+
+        return self.written_size
+
+    def read_range(self, offset, length):
+        """Read a range of bytes of the written file.
+
+        Args:
+            offset: The offset of the first byte to read.
+            length: The number of bytes to read.
+
+        Returns:
+            The bytes of the range.
+        """
+
+        with open(self.path, 'rb') as file_:
+            file_.seek(offset)
+            return file_.read(length)
+
+    def read_blocks(self, depth=0):
+        """Read the contents of the written file a piece at a time.
+
+        Args:
+            depth: Unused, the written file is read directly.
+
+        Yields:
+            The contents of the file, READ_SIZE bytes at a time.
+        """
+
+        with open(self.path, 'rb') as file_:
+            for data in iter(lambda: file_.read(READ_SIZE), b''):
+                yield data
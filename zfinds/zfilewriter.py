@@ -1,5 +1,11 @@
 import logging
 import os
+import Queue
+import threading
+
+from .stats import STATS
+
+WRITE_QUEUE = 64  # Files waiting to be written while pipelining
 
 
 class ZFileWriter(object):
@@ -8,17 +14,37 @@ class ZFileWriter(object):
     Class to write the list of found ZFiles to a given location. Once the file
     is written to the file system the access and modify times of the file are
     updated to reflect the access and modify times on the ZFile.
+
+    Files are written by a pool of worker threads. Files can also be written
+    as they are found. After start() is called files given to put() are
+    queued and written until finish() is called. The queue is bounded so
+    that files are not found faster than they can be written.
+
+    File names are assigned in the order files are given, so they do not
+    depend on the order the workers write them in. Errors writing a file do
+    not stop the other files from being written; they are reported once all
+    files have been written.
     """
 
-    def __init__(self, base_path):
+    def __init__(self, base_path, workers=1, read_ahead=0):
         """Initialize ZFileWriter.
 
         Args:
             base_path: path to where files should be saved.
+            workers: The number of threads to write files with.
+            read_ahead: The number of blocks of a file to read ahead of the
+                block being written.
         """
 
         self.base_path = os.path.abspath(base_path)
+        self.workers = workers
+        self.read_ahead = read_ahead
         self.log = logging.getLogger(__name__)
+        self.file_count = 0
+        self.postfix = None
+        self.queue = None
+        self.threads = []
+        self.errors = []
 
         if os.path.exists(self.base_path):
             if not os.path.isdir(self.base_path):
@@ -26,7 +52,7 @@ class ZFileWriter(object):
         else:
             os.mkdir(self.base_path)
 
-    def write(self, zfiles, postfix):
+    def write(self, zfiles, postfix, on_written=None):
         """Write the ZFiles to the file system.
 
         Writes the ZFile data to the file system in the location specified by
@@ -36,29 +62,174 @@ class ZFileWriter(object):
         Args:
             zfiles: List of ZFileInfo objects to write.
             postfix: String to append to the end of the file name.
+            on_written: Function called with each ZFileInfo and the path it
+                was written to, see put().
+
+        Returns:
+            A list of (file_name, error) tuples for the files that could not
+            be written.
         """
 
-        self.log.info('Writing files')
-        file_count = 0
+        self.start(postfix)
 
         for zfileinfo in zfiles:
-            atime = zfileinfo.zfile.znode.atime[0]
-            mtime = zfileinfo.zfile.znode.mtime[0]
+            self.put(zfileinfo, on_written)
+
+        return self.finish()
 
-            if zfileinfo.name:
-                file_name = '{0}-{1}-{2}'.format(
-                    zfileinfo.name, mtime, postfix)
-            else:
-                file_count += 1
-                file_name = '{0:05}-{1}-{2}'.format(file_count, mtime, postfix)
+    def start(self, postfix, depth=WRITE_QUEUE):
+        """Start writing files as they are given to put().
 
-            self.log.info('Found file: %s', file_name)
+        Args:
+            postfix: String to append to the end of the file names.
+            depth: The number of files that may wait to be written.
+        """
 
-            file_path = os.path.join(self.base_path, file_name)
-            zfile = zfileinfo.zfile
+        self.log.info('Writing files')
+        self.file_count = 0
+        self.postfix = postfix
+        self.errors = []
+        self.queue = Queue.Queue(max(depth, self.workers))
 
-            file_ = open(file_path, 'w')
-            file_.write(zfile.read())
-            file_.close()
+    def put(self, zfileinfo, on_written=None):
+        """Queue a ZFile to be written.
+
+        Blocks while the queue is full. The writing threads are started by
+        the first call, so that no thread is running while worker processes
+        are forked before any file is found.
+
+        Args:
+            zfileinfo: The ZFileInfo object to write.
+            on_written: Function called from the writing thread with the
+                ZFileInfo and the path it was written to once it has been
+                written.
+        """
+
+        if not self.threads:
+            for _ in xrange(self.workers):
+                thread = threading.Thread(target=self._drain)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+        file_name = self._file_name(zfileinfo, self.postfix)
+        self.queue.put((zfileinfo, file_name, on_written))
+
+    def finish(self):
+        """Wait for all queued files to be written.
+
+        Logs an error for every file that could not be written.
+
+        Returns:
+            A list of (file_name, error) tuples for the files that could not
+            be written.
+        """
+
+        for _ in self.threads:
+            self.queue.put(None)
+
+        for thread in self.threads:
+            thread.join()
+
+        self.queue = None
+        self.threads = []
+        self.errors.sort(key=lambda error: error[0])
+
+        for file_name, error in self.errors:
+            self.log.error('Unable to write file %s: %s', file_name, error)
+
+        return self.errors
+
+    def _drain(self):
+        """Write queued files until finish() is called."""
+
+        while True:
+            item = self.queue.get()
 
+            if item is None:
+                return
+
+            zfileinfo, file_name, on_written = item
+
+            try:
+                file_path = self._write_file(zfileinfo, file_name)
+            except Exception as error:
+                self.errors.append((file_name, error))
+                continue
+
+            if on_written is not None:
+                on_written(zfileinfo, file_path)
+
+    def _file_name(self, zfileinfo, postfix):
+        """Create the file name to write a ZFile to.
+
+        Files without a name are numbered in the order they are given.
+
+        Args:
+            zfileinfo: The ZFileInfo object to name.
+            postfix: String to append to the end of the file name.
+
+        Returns:
+            The file name of the ZFile.
+        """
+
+        mtime = zfileinfo.zfile.znode.mtime[0]
+
+        if zfileinfo.name:
+            file_name = '{0}-{1}-{2}'.format(zfileinfo.name, mtime, postfix)
+        else:
+            self.file_count += 1
+            file_name = '{0:05}-{1}-{2}'.format(self.file_count, mtime,
+                                                 postfix)
+
+        return file_name
+
+    def _write_file(self, zfileinfo, file_name):
+        """Write a ZFile to the file system.
+
+        If the contents of the ZFile were already saved to a temporary file
+        while it was hashed, the temporary file is renamed into place instead
+        of the ZFile being read again.
+
+        Args:
+            zfileinfo: The ZFileInfo object to write.
+            file_name: The name of the file to write to.
+
+        Returns:
+            The path the ZFile was written to.
+        """
+
+        atime = zfileinfo.zfile.znode.atime[0]
+        mtime = zfileinfo.zfile.znode.mtime[0]
+
+        self.log.info('Found file: %s', file_name)
+
+        file_path = os.path.join(self.base_path, file_name)
+
+        if zfileinfo.spool is not None:
+            os.rename(zfileinfo.spool, file_path)
+            zfileinfo.spool = None
             os.utime(file_path, (atime, mtime))
+            STATS.add('files_written')
+            return file_path
+
+        file_ = open(file_path, 'wb')
+        written = 0
+
+        try:
+            with STATS.timer('write'):
+                for data in zfileinfo.read_blocks(self.read_ahead):
+                    file_.write(data)
+                    written += len(data)
+        except Exception:
+            file_.close()
+            os.unlink(file_path)
+            raise
+
+        file_.close()
+
+        os.utime(file_path, (atime, mtime))
+        STATS.add('files_written')
+        STATS.add('bytes_written', written)
+
+        return file_path
@@ -1,121 +1,479 @@
+import functools
 import logging
+import os
 import zfspy
 
+from .blockcache import BLOCK_CACHE_SIZE, BlockCache
+from .filecache import FileCache
+from .monkeypatch import clear_txg_index
+from .readahead import READ_AHEAD
+from .scanjournal import ScanJournal
+from .sectormap import SectorMap
 from .sectortracker import SectorTracker
+from .stats import STATS
 from .zfilehash import ZFileHash
 from .zfileinfo import ZFileInfo
 from .utils import (
+    SCAN_WINDOW,
+    SECTOR_SIZE,
     dnode_scan,
+    get_dev_size,
     get_file_from_dnode,
+    get_free_map,
     get_uberblocks,
     get_vdev_info,
+    load_file,
     walk_files,
+    walk_txgs,
     )
 
+JOURNAL_NAME = '.zfinds-brute.journal'
+BRUTE_TYPES = ('DMU_OT_PLAIN_FILE_CONTENTS',)  # Dnode types the brute finds
+
 
 class Zfinds(object):
     """Contains all objects related to data recovery.
 
     The Zfinds object contains all of the necessary objects to perform data
     recovery on the given ZFS file system.
+
+    A Zfinds replaces zfspy.zio.ZIO functions with its BlockCache and
+    SectorTracker, which only apply to its own disk. Only one Zfinds may be
+    open in a process at a time; close() restores the replaced functions so
+    that another can be created.
     """
 
-    def __init__(self, disk, writer):
+    def __init__(self, disk, writer, block_cache_size=BLOCK_CACHE_SIZE,
+                 algorithm='sha256', hash_jobs=1, pipeline=False,
+                 single_read=False, read_ahead=READ_AHEAD,
+                 exclude_by='identity'):
         """Initialize Zfinds.
 
         Args:
             disk: The path to the disk to perform recovery.
             writer: The ZFileWriter to use for data output.
+            block_cache_size: The maximum number of bytes of blocks to cache
+                while walking the file system. If 0 blocks are not cached.
+            algorithm: The name of the hashlib algorithm to hash files with.
+            hash_jobs: The number of threads to hash files with.
+            pipeline: If True, files are written as they are found instead
+                of after each recovery method has finished.
+            single_read: If True, the data of found files that are hashed is
+                saved to the destination while they are hashed, so that they
+                are not read again when written.
+            read_ahead: The number of blocks of a file, or windows of the
+                brute scan, to read ahead of the one being used.
+            exclude_by: How the files of the current file system are kept,
+                'identity' to keep them by the checksums of their block
+                pointers without reading them, or 'content' to also compare
+                their contents with each other. Either way the sectors of
+                their blocks are marked as used, see build_cache().
         """
 
         self.disk = disk
         self.writer = writer
-        self.files = ZFileHash()
+        self.algorithm = algorithm
+        self.hash_jobs = hash_jobs
+        self.pipeline = pipeline
+        self.read_ahead = read_ahead
+        self.spool_dir = writer.base_path if single_read else None
+        self.files = self._new_filehash(compare=exclude_by == 'content')
         self.files_uber = None
         self.files_brute = None
         self.tracker = None
+        self.free_map = None
+        self.journal = None
+        self.pool_txg = None
+        self.block_cache = None
+        self.patched = []
         self.vdev_info = get_vdev_info(self.disk)
         self.log = logging.getLogger(__name__)
 
-    def build_cache(self):
+        if block_cache_size:
+            self.block_cache = BlockCache(zfspy.zio.ZIO.read_blk,
+                                          block_cache_size)
+            self._patch('read_blk', self.block_cache)
+
+    def _patch(self, name, wrapper):
+        """Replace a zfspy.zio.ZIO function until the Zfinds is closed.
+
+        Args:
+            name: The name of the function to replace.
+            wrapper: The callable to replace the function with.
+
+        Raises:
+            RuntimeError: The function is already replaced by another open
+                Zfinds.
+        """
+
+        current = getattr(zfspy.zio.ZIO, name)
+
+        if isinstance(current, (BlockCache, SectorTracker)):
+            raise RuntimeError('ZIO.{0} is in use by another Zfinds, close '
+                               'it first'.format(name))
+
+        self.patched.append((name, vars(zfspy.zio.ZIO).get(name)))
+        setattr(zfspy.zio.ZIO, name, wrapper)
+
+    def close(self):
+        """Restore the zfspy.zio.ZIO functions replaced by the Zfinds.
+
+        The UberBlocks indexed from the vdevs are also forgotten, so that a
+        later Zfinds of the same paths does not use a stale index.
+        """
+
+        clear_txg_index()
+
+        while self.patched:
+            name, original = self.patched.pop()
+
+            if original is None:
+                delattr(zfspy.zio.ZIO, name)
+            else:
+                setattr(zfspy.zio.ZIO, name, original)
+
+    def _new_filehash(self, exclude=None, postfix=None, compare=True):
+        """Create a ZFileHash using the configured hashing settings.
+
+        A postfix is given for ZFileHashes of found files. Their data is
+        saved while hashing when single_read is set, and when pipelining
+        the ZFileWriter is started and the files added to the ZFileHash are
+        queued to be written, and released from it once written.
+
+        Args:
+            exclude: ZFileHash of objects to exclude from the ZFileHash.
+            postfix: String to append to the end of written file names.
+            compare: If False, files are added by their identity without
+                being compared.
+
+        Returns:
+            A new, empty ZFileHash.
+        """
+
+        spool_dir = self.spool_dir if postfix else None
+        filehash = ZFileHash(exclude, self.algorithm, self.hash_jobs, None,
+                             spool_dir, self.read_ahead, compare)
+
+        if postfix and self.pipeline:
+            self.writer.start(postfix)
+            filehash.on_add = functools.partial(self.writer.put,
+                                                on_written=filehash.release)
+
+        return filehash
+
+    def _close_filehash(self, filehash):
+        """Finish adding files to a ZFileHash.
+
+        When pipelining, waits for the added files to be written.
+
+        Args:
+            filehash: The ZFileHash created by _new_filehash().
+        """
+
+        try:
+            filehash.close()
+        finally:
+            if filehash.on_add is not None:
+                self.writer.finish()
+
+    def _log_block_cache(self):
+        """Log the hits and misses of the block cache."""
+
+        if self.block_cache:
+            self.log.info('Block cache: %s hits, %s misses',
+                          self.block_cache.hits, self.block_cache.misses)
+
+    def build_cache(self, map_dir=None, cache_dir=None):
         """Builds a cache of files on current file system.
 
-        Walks the current file system hashing all of the files to add to the
+        Walks the current file system adding all of the files to the
         ZFileHash. The cache is necessary so that current files are not
-        returned as 'found' files.
+        returned as 'found' files. Unless the Zfinds excludes files by
+        content, the files are kept by their identity and are not read; a
+        current file is only hashed when a found file of the same size has a
+        different identity.
+
+        The sectors of the blocks of the files are marked as used from their
+        block pointers, whether or not the files are read, so that the brute
+        method does not scan them. Only their indirect blocks are read.
+
+        When a cache_dir is given the files and used sectors found by the
+        walk are saved there, and the walk is skipped if a saved cache of
+        the same pool, active txg and device size is found.
+
+        Args:
+            map_dir: Directory to memory map the map of used sectors in. If
+                None the map is kept in memory.
+            cache_dir: Directory to save and load the cache in. If None the
+                cache is not saved.
         """
 
         self.log.info('Building file cache.')
-        self.tracker = SectorTracker(zfspy.zio.ZIO.read, self.disk)
-        zfspy.zio.ZIO.read = self.tracker
+        self.tracker = SectorTracker(zfspy.zio.ZIO.read, self.disk, map_dir)
+        self._patch('read', self.tracker)
+
+        pool = zfspy.ZPool(self.vdev_info)
+        pool.load()
+        self.pool_txg = pool.spa.ubbest.ub_txg
+
+        file_cache = None
+
+        if cache_dir:
+            file_cache = FileCache(cache_dir, self.vdev_info.pool_guid,
+                                   self.pool_txg, self.disk)
+
+            if file_cache.load(pool, self.files, self.tracker.sector_map):
+                return
+
+        walk_files(pool, self.files, mark=self.tracker.mark)
+        self.files.close()
+        self._log_block_cache()
 
+        if file_cache:
+            self.tracker.flush()
+            file_cache.save(self.files, self.tracker.sector_map)
+
+    def build_free_map(self, map_dir=None):
+        """Find the sectors for the brute method to scan from space maps.
+
+        Reads the metaslab space maps of the active txg of the pool, so that
+        the brute method scans exactly the sectors that are free instead of
+        the sectors that were not read while building the cache of existing
+        files.
+
+        Args:
+            map_dir: Directory to memory map the map of allocated sectors in.
+                If None the map is kept in memory.
+
+        Returns:
+            True if the pool has space maps, False if it does not, in which
+            case the brute method falls back to the sectors not read while
+            building the cache.
+        """
+
+        self.log.info('Reading space maps.')
         pool = zfspy.ZPool(self.vdev_info)
         pool.load()
-        walk_files(pool, self.files)
+        self.pool_txg = pool.spa.ubbest.ub_txg
+        self.free_map = get_free_map(pool, self.disk, map_dir)
+
+        if self.free_map is None:
+            self.log.warn('Pool has no space maps')
+            return False
+
+        return True
+
+    def _scan_map(self):
+        """Retrieve the SectorMap of the sectors the brute method skips.
+
+        Returns:
+            The map of allocated sectors from the space maps if it was built,
+            otherwise the map of the sectors read while building the cache of
+            existing files. If neither was built every sector is scanned.
+        """
 
-    def find_brute(self):
+        if self.free_map is not None:
+            return self.free_map
+
+        if self.tracker is not None:
+            # Reads made from here on are of unused sectors, there is no need
+            # to track them.
+            self.tracker.track = False
+            return self.tracker.get_map()
+
+        return SectorMap(get_dev_size(self.disk) / SECTOR_SIZE)
+
+    def find_brute(self, window_size=SCAN_WINDOW, use_mmap=False, jobs=1,
+                   resume=False):
         """Perform data recovery via the brute method.
 
         Recovers data from the ZFS file system by attempting to locate dnodes
-        of the type DMU_OT_PLAIN_FILE_CONTENTS. When a dnode of the correct
-        type is found it is added to the ZFileHash.
+        of the type DMU_OT_PLAIN_FILE_CONTENTS. Dnodes are added to the
+        ZFileHash as the scan finds them, and dnodes of other types are
+        dropped by the scan.
+
+        The sectors scanned are those free in the space maps when
+        build_free_map() was called, otherwise those not read by
+        build_cache().
+
+        The progress of the scan is recorded in a journal in the destination
+        until the found files have been written, so that an interrupted scan
+        can be resumed. The dnodes recorded in the journal are added in the
+        same order as they were found, so a resumed scan finds the same files
+        as an uninterrupted one.
+
+        Args:
+            window_size: The number of bytes to read from disk at a time.
+            use_mmap: If True, memory map the disk instead of reading it.
+            jobs: The number of processes to scan the disk with.
+            resume: If True, continue the scan from the journal left by an
+                interrupted scan of the same pool, if there is one.
         """
 
         self.log.info('Running brute method.')
-        self.files_brute = ZFileHash(exclude=self.files+self.files_uber)
+        self.files_brute = self._new_filehash(self.files+self.files_uber,
+                                              'brute')
+
+        sector_map = self._scan_map()
+        key = (self.vdev_info.pool_guid, self.pool_txg,
+               get_dev_size(self.disk), self.free_map is not None)
+        self.journal = ScanJournal(
+            os.path.join(self.writer.base_path, JOURNAL_NAME), key)
+
+        if not (resume and self.journal.load()):
+            self.journal.create()
 
         dnodes = dnode_scan(self.disk, self.vdev_info.vdev_tree,
-                            self.tracker.get_map())
+                            sector_map, window_size, use_mmap,
+                            jobs, self.journal, BRUTE_TYPES,
+                            self.read_ahead)
 
-        for dnode in dnodes:
-            if dnode.type != 'DMU_OT_PLAIN_FILE_CONTENTS':
-                continue
+        try:
+            with STATS.timer('scan'):
+                for dnode in dnodes:
+                    zfile = get_file_from_dnode(dnode)
+                    self.files_brute.add(ZFileInfo(zfile))
+        finally:
+            self.journal.close()
 
-            zfile = get_file_from_dnode(dnode)
-            self.files_brute.add(ZFileInfo(zfile))
+        self._close_filehash(self.files_brute)
 
-    def find_uber(self):
+    def find_uber(self, jobs=1):
         """Perform data recover via the uber method.
 
         Recovers data from the ZFS file system by checking all available
         uberblocks for a valid file system, and then scanning those file
         systems for files. When a file is found it is added to the ZFileHash.
+
+        When more than one job is requested the txgs are walked concurrently
+        by worker processes. The results are merged in the same order the
+        txgs are walked in with a single job, so the same files are found.
+
+        A file whose identity was already given to the ZFileHash, such as a
+        file unchanged since a walked txg, is skipped before it is read or
+        hashed. Every directory of every txg is still walked, as changing a
+        file does not change the directory it is in; metadata blocks that
+        did not change between txgs are read from the block cache.
+
+        Args:
+            jobs: The number of processes to walk the txgs with.
         """
 
         self.log.info('Running uber method.')
-        self.files_uber = ZFileHash(exclude=self.files)
+        self.files_uber = self._new_filehash(self.files, 'uber')
         ubblocks = get_uberblocks(self.disk, self.vdev_info.vdev_tree)
+        STATS.start_progress('uber', len(ubblocks), 'txgs')
+
+        if jobs > 1:
+            results = walk_txgs(self.vdev_info, ubblocks.keys(), jobs,
+                                self.algorithm, self.hash_jobs,
+                                self.spool_dir, self.read_ahead)
+
+            for done, (txg, error, files) in enumerate(results, 1):
+                self._merge_txg(txg, files)
+                STATS.progress(done)
+
+                if error == 'fat_zap':
+                    self.log.warn('Found fat ZAP in txg %s', txg)
+                    STATS.add('txgs_fat_zap')
+                elif error:
+                    self.log.debug('Error on txg %s', txg)
+                    STATS.add('txgs_failed')
+                    continue
+
+                self.log.debug('Walked txg %s', txg)
+                STATS.add('txgs_walked')
+        else:
+            for done, txg in enumerate(ubblocks.keys(), 1):
+                pool = zfspy.ZPool(self.vdev_info)
+
+                try:
+                    pool.load(txg)
+                    walk_files(pool, self.files_uber)
+                except NotImplementedError:
+                    self.log.warn('Found fat ZAP in txg %s', txg)
+                    STATS.add('txgs_fat_zap')
+                except Exception:
+                    self.log.debug('Error on txg %s', txg)
+                    STATS.add('txgs_failed')
+                    continue
+                finally:
+                    STATS.progress(done)
+
+                self.log.debug('Walked txg %s', txg)
+                STATS.add('txgs_walked')
+
+        self._close_filehash(self.files_uber)
+        self._log_block_cache()
+
+    def _merge_txg(self, txg, files):
+        """Add the files found by a worker walking a txg to the ZFileHash.
 
-        for txg in ubblocks.keys():
-            pool = zfspy.ZPool(self.vdev_info)
+        Files whose identity is already known to the ZFileHash are skipped
+        without loading them. The hashes generated by the worker are kept on
+        the loaded files so that they are not generated again.
+
+        Args:
+            txg: The txg the files were found in.
+            files: A list of (identity, partial, digest, spool, name, obj_id)
+                tuples of the files, see walk_txgs.
+        """
+
+        pool = None
+
+        for key, partial, digest, spool, name, obj_id in files:
+            if self.files_uber.has_identity(key):
+                STATS.add('files_identical')
+
+                if spool is not None:
+                    os.unlink(spool)
+                continue
 
             try:
-                pool.load(txg)
-                walk_files(pool, self.files_uber)
-            except NotImplementedError:
-                self.log.warn('Found fat ZAP in txg %s', txg)
+                if pool is None:
+                    pool = zfspy.ZPool(self.vdev_info)
+                    pool.load(txg)
+
+                zfileinfo = load_file(pool, obj_id, name)
             except Exception:
-                self.log.debug('Error on txg %s', txg)
+                self.log.debug('Error loading object %s on txg %s', obj_id,
+                               txg)
+
+                if spool is not None:
+                    os.unlink(spool)
                 continue
 
-            self.log.debug('Walked txg %s', txg)
+            zfileinfo.partial = partial
+            zfileinfo.digest = digest
+            zfileinfo.spool = spool
+            self.files_uber.add(zfileinfo)
 
     def write_brute(self):
         """Save the files found via the brute method.
 
         Uses the ZFileWriter that was given to save the files that were found
-        via the brute method.
+        via the brute method. When pipelining the files have already been
+        written by find_brute. The journal of the scan is then removed.
         """
 
-        self.log.info('Writing brute files.')
-        self.writer.write(self.files_brute.values(), 'brute')
+        if not self.pipeline:
+            self.log.info('Writing brute files.')
+            self.writer.write(self.files_brute.zfiles(), 'brute',
+                              self.files_brute.release)
+
+        self.journal.remove()
 
     def write_uber(self):
         """Save the files found via the uber method.
 
         Uses the ZFileWriter that was given to save the files that were found
-        via the uber method.
+        via the uber method. When pipelining the files have already been
+        written by find_uber and nothing is done.
         """
 
+        if self.pipeline:
+            return
+
         self.log.info('Writing uber files.')
-        self.writer.write(self.files_uber.values(), 'uber')
+        self.writer.write(self.files_uber.zfiles(), 'uber',
+                          self.files_uber.release)